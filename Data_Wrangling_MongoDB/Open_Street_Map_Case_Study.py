@@ -14,10 +14,13 @@ Note that your code will be tested with a different data file than the 'example.
 
 import xml.etree.cElementTree as ET
 import pprint
+import sys
+sys.path.append("./tools/")
+from osm_stream import iterparse_clear, iter_elements
 
 def count_tags(filename):
     info = {}
-    for _, element in ET.iterparse(filename):
+    for element in iterparse_clear(filename):
         info[element.tag] = info.get(element.tag, 0) + 1
     return info
 
@@ -82,7 +85,7 @@ def key_type(element, keys):
 
 def process_map(filename):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
+    for element in iterparse_clear(filename):
         keys = key_type(element, keys)
     return keys
 
@@ -112,7 +115,7 @@ def get_user(element):
 
 def process_map(filename):
     users = set()
-    for _, element in ET.iterparse(filename):
+    for element in iter_elements(filename):
         try:
             user = element.attrib['uid']
             users.add(user)
@@ -170,11 +173,10 @@ def is_street_name(elem):
 def audit(osmfile):
     osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
+    for elem in iter_elements(osm_file, ("node", "way")):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
     return street_types
 
 def update_name(name, mapping):
@@ -287,6 +289,7 @@ import pprint
 import re
 import codecs
 import json
+import osm_convert
 
 lower = re.compile(r'^([a-z]|_)*$')
 lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
@@ -351,18 +354,9 @@ def shape_element(element):
         return None
 
 def process_map(file_in, pretty = False):
-    file_out = "{0}.json".format(file_in)
-    data = []
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
-            if el:
-                data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
-    return data
+    # stream the shaped elements to the json file; collect=True also
+    # returns them as a list, which the test below needs (small file only)
+    return osm_convert.process_map(file_in, pretty, collect=True, shape=shape_element)
 
 def test():
     # NOTE: if you are running this code on your computer, with a larger dataset, 
@@ -30,16 +30,24 @@
 
 # In[2]:
 
-import numpy as np
 import pandas as pd
-import xml.etree.cElementTree as ET
 import matplotlib.pyplot as plt
 import pprint
 import re
-import codecs
 import json
-import os
-from collections import defaultdict
+import sys
+import glob
+sys.path.append("./tools/")
+from osm_audit import unexpected_street_types
+from osm_streets import StreetNormalizer
+from osm_columnar import columnar_cache, audit_tables, clean_tags, clean_value_counts
+from osm_convert import process_map
+from osm_clean import load_rules
+from osm_mongo import load_map, apply_changes
+from osm_indexes import create_indexes, print_explain_report
+from osm_runner import run_report, print_timings, explain_report
+from osm_spatial import density_tile, plot_density
+from osm_affiliation import polygons_from_collection, tag_affiliations
 
 
 # ## Import Data
@@ -49,45 +57,38 @@ from collections import defaultdict
 # In[3]:
 
 # input xml file, open street map (south bend, IN)
+# (the downloaded south-bend_indiana.osm.bz2 can be used as it is: .bz2,
+# .gz, and .xz files are decompressed on the fly, see tools/osm_stream.py)
 file_in = 'data-south-bend-indiana.osm'
 
 
 # In[4]:
 
-# count number of tags
-# source: modified code from udacity case study
-info = {}
-for _ , element in ET.iterparse(file_in):
-    info[element.tag] = info.get(element.tag, 0) + 1
-pprint.pprint(info)
+# parse the file once into columnar tables (nodes, ways, relations, tags,
+# nds, members), cached next to the file and only rebuilt when it changes
+tables = columnar_cache(file_in)
+
+
+# In[ ]:
+
+# audit the tables: tag counts, users, street types, and the value counts
+# of every tag that is cleaned below (see tools/osm_audit.py for the same
+# audits streamed from the xml in a single pass)
+audit = audit_tables(tables, ["tiger:name_type", "tiger:zip_left",
+                              "tiger:county", "surface"])
+values = audit["values"]["count"]
 
 
 # In[5]:
 
-# function that outputs top users
-# source: modified code from udacity case study
-def top_users(filename):
-    users = []
-    for _ , element in ET.iterparse(filename):
-        try:
-            user = element.attrib['uid']
-            users.append(user)
-        except:
-            pass
-    names = []
-    for _ , element in ET.iterparse(filename):
-        try:
-            name = element.attrib['user']
-            names.append(name)
-        except:
-            pass
-    return users,names
+# count number of tags
+pprint.pprint(audit["tags"])
 
 
 # In[6]:
 
 # top users
-pd.Series( top_users(file_in)[1] ).value_counts().head(10)
+pd.Series( audit["users"]["user"] ).sort_values(ascending=False).head(10)
 
 
 # ## Clean Data
@@ -114,72 +115,30 @@ mapping_street_name = { "Ave": "Avenue", "Blvd": "Boulevard",
                         "Trl" : "Trail" }
 
 
-# In[8]:
-
-# function to audit street names
-# source: modified code from udacity case study
-def audit_street_name(osmfile):
-    osm_file = open(osmfile, "r")
-    street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    return street_types
-
-
-# In[9]:
-
-# function to test if tag is a street name
-# source: modified code from udacity case study
-def is_street_name(elem):
-    return ( (elem.attrib['k'] == "addr:street") or (elem.attrib['k'] == "name") )
-
-
-# In[10]:
-
-# function that compares acutal street names to the expected
-# source: modified code from udacity case study
-def audit_street_type(street_types, street_name):
-    m = street_type_re.search(street_name)
-    if m:
-        street_type = m.group()
-        if street_type not in expected:
-            street_types[street_type].add(street_name)
-
-
 # In[11]:
 
 # display possible street name errors to fix
-st_types = audit_street_name(file_in)
-pprint.pprint(dict(st_types))
+# (street types from the single audit pass that are not expected)
+st_types = unexpected_street_types(audit["street_types"], expected)
+pprint.pprint(st_types)
 
 
 # In[13]:
 
 # function that will update street names
-# source: modified code from udacity case study
-def update_street(name, mapping_street_name):
-    m = street_type_re.search(name)
-    if m:
-        x = m.group()
-        new = name.replace(x, mapping_street_name[x])
-    return new
+# (replaces only the last word, the street type, if it is in the mapping;
+# see tools/osm_streets.py)
+update_street = StreetNormalizer(mapping_street_name)
 
 
 # In[14]:
 
 # preview street names after cleaning
+# (only a preview: the conversion below fixes every street name it meets)
 # source: modified code from udacity case study
 updates_street_names = {}
 for st_type, ways in st_types.iteritems():
-    for name in ways:
-        try:
-            better_name = update_street(name, mapping_street_name)
-            updates_street_names[name] = better_name
-        except:
-            pass
+    updates_street_names.update( update_street.fixes(ways) )
 updates_street_names
 
 
@@ -209,39 +168,17 @@ mapping_tiger_type = { "Ave:Blvd" : "Avenue", "Ave:Rd" : "Boulevard",
                          "Brg" : "Bridge" }
 
 
-# In[16]:
-
-# function to audit any tag
-# source: modified code from udacity case study
-def audit_any_tag(osmfile, any_tag):
-    osm_file = open(osmfile, "r")
-    data = []
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if (tag.attrib['k'] == any_tag ):
-                    data.append( tag.attrib['v'] )
-    return data
-
-
 # In[17]:
 
 # view values of tiger name_type
-tiger_types = pd.Series( audit_any_tag(file_in, "tiger:name_type") )
-tiger_types.value_counts().index
+tiger_types = values["tiger:name_type"]
+tiger_types.index
 
 
 # In[18]:
 
 # preview tiger name_type after cleaning
-updates_tiger_types = []
-for each in tiger_types:
-    if each in mapping_tiger_type.keys():
-        new = mapping_tiger_type[each]
-        updates_tiger_types.append(new)
-    else:
-        updates_tiger_types.append(each)
-pd.Series( updates_tiger_types ).value_counts().index
+clean_value_counts(tiger_types, "tiger:name_type", tiger_types=mapping_tiger_type).index
 
 
 # ### 3. Zip Codes
@@ -252,18 +189,15 @@ pd.Series( updates_tiger_types ).value_counts().index
 
 # CLEAN STEP 3: Clean Zip codes (tiger:zip_left)
 # view zip codes
-zips = pd.Series( audit_any_tag(file_in, "tiger:zip_left") )
-zips.value_counts().index
+zips = values["tiger:zip_left"]
+zips.index
 
 
 # In[20]:
 
 # preview cleaned zip data
 # if multiple zip codes, only use the first
-new_zips = []
-for each in zips:
-    new_zips.append( each[:5] )
-pd.Series( new_zips ).value_counts().index
+clean_value_counts(zips, "tiger:zip_left").index
 
 
 # ### 4. County Names
@@ -274,23 +208,15 @@ pd.Series( new_zips ).value_counts().index
 
 # CLEAN STEP 4: Clean County Names
 # view county values
-county = pd.Series( audit_any_tag(file_in, "tiger:county") )
-county.value_counts().index
+county = values["tiger:county"]
+county.index
 
 
 # In[22]:
 
 # preview cleaned county
 # if multiple, only use the first (; and : delimiters)
-new_county = []
-for each in county:
-    if ':' in each or ';' in each:
-        edit = str.replace(each, ";",":")
-        new = edit.split(':')[0]
-        new_county.append(new)
-    else:
-        new_county.append(each)
-pd.Series( new_county ).value_counts().index
+clean_value_counts(county, "tiger:county").index
 
 
 # ### 5. Road Surfaces
@@ -301,8 +227,8 @@ pd.Series( new_county ).value_counts().index
 
 # CLEAN STEP 5: Street Surfaces
 # view surface values
-surface = pd.Series( audit_any_tag(file_in, "surface") )
-surface.value_counts()
+surface = values["surface"]
+surface
 
 
 # In[24]:
@@ -315,14 +241,7 @@ mapping_surface = { "paved,_gravel" : "gravel", "fine_gravel" : "gravel",
 # In[25]:
 
 # preview surfaces after cleaning
-surface_types = []
-for each in surface:
-    if each in mapping_surface.keys():
-        new = mapping_surface[each]
-        surface_types.append(new)
-    else:
-        surface_types.append(each)
-pd.Series( surface_types ).value_counts()
+clean_value_counts(surface, "surface", surfaces=mapping_surface)
 
 
 # ## Convert to JSON Format
@@ -331,135 +250,40 @@ pd.Series( surface_types ).value_counts()
 
 # In[26]:
 
-# Output to JSON format
-# function that converts xml to json/mangoDB
-# source: modified code from udacity case study
-def process_map(file_in, pretty = False):
-    file_out = "{0}.json".format(file_in)
-    data = []
-    with codecs.open(file_out, "w") as fo:
-        for _ , element in ET.iterparse(file_in):
-            el = shape_element(element)
-            if el:
-                data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
-    return True
-
-
-# In[27]:
-
-# function that cleans data and converts xml into json/mangoDB format
-# source: modified code from udacity case study
-def shape_element(element):
-
-    CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
-    problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-    street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
-
-    # empty dictionary to store node data
-    node = {}
-
-    # if element is a node or way
-    if element.tag == "node" or element.tag == "way" :
-
-        # empty dictionaries to store tags
-        created = {}
-        address = {}
-        tiger = {}
-        gnis = {}
-
-        # iterate over all attributes
-        for x in element.attrib:
-            # collect created attributes for sub-dictionary
-            if x in CREATED:
-                created[x] = element.attrib[x]
-            # collect lat and lon for list
-            elif x == "lat":
-                lat = float( element.attrib.get("lat") )
-            elif x == "lon":
-                lon = float( element.attrib.get("lon") )
-            # add all other attributes to top level of dictionary
-            else:
-                node[x] = element.attrib[x]
-
-        # add type, created if not empty, and position if exisits
-        node["type"] = element.tag
-        if len(created) > 0:
-            node["created"] = created
-        try:
-            node["pos"] = [lat, lon]
-        except:
-            pass
-
-        # parse tags
-        for tag in element.iter("tag"):
-            tag_key = tag.attrib['k']
-            tag_value = tag.attrib['v']
-
-            # CLEAN DATA STEP 1 - street names (addr:street and name)
-            if tag_value in updates_street_names.keys():
-                tag_value = updates_street_names[tag_value]
-            # CLEAN DATA STEP 2 - tiger street type (tiger:name_type)
-            if tag_value in mapping_tiger_type.keys():
-                tag_value = mapping_tiger_type[tag_value]
-            # CLEAN DATA STEP 3 - zip codes (tiger:zip_left and tiger:zip_right)
-            if tag_key == "tiger:zip_left" or tag_key == "tiger:zip_right" :
-                tag_value = tag_value[:5]
-            # CLEAN DATA STEP 4 - county names (tiger:county)
-            if tag_key == "tiger:county":
-                if ':' in tag_value or ';' in tag_value:
-                    edit = str.replace(tag_value, ";",":")
-                    tag_value = edit.split(':')[0]
-            # CLEAN DATA STEP 5 - road surfaces (surface:)
-            if tag_key == "surface":
-                if tag_value in mapping_surface.keys():
-                    tag_value = mapping_surface[tag_value]
-
-            # ignore tags with problem characters
-            if problemchars.match(tag_key):
-                pass
-            # ignore tags with multiple colons
-            elif tag_key.count(":") > 1:
-                pass
-            # tags with addr:, tiger:, or gnis:
-            elif tag_key.startswith("addr:"):
-                address[ tag_key.split(":")[1] ] = tag_value
-            elif tag_key.startswith("tiger:"):
-                tiger[ tag_key.split(":")[1] ] = tag_value
-            elif tag_key.startswith("gnis:"):
-                gnis[ tag_key.split(":")[1] ] = tag_value
-            # process all other tags
-            else:
-                node[tag_key] = tag_value
-
-        # add address, tiger, and gnis sub-dictionaries if not empty
-        if len(address) > 0:
-            node["address"] = address
-        if len(tiger) > 0:
-            node["tiger"] = tiger
-        if len(gnis) > 0:
-            node["gnis"] = gnis
-
-        # add refs
-        refs = []
-        for nd in element.iter("nd"):
-            refs.append( nd.attrib['ref'] )
-        if len(refs) > 0:
-            node["node_refs"] = refs
-        return node
-
-    # if element is not node or way, ignore
-    else:
-        return None
+# cleaning rules by tag key, with the mappings created above
+# (see tools/osm_clean.py and tools/rules/south_bend.json)
+mappings = load_rules("./tools/rules/south_bend.json")
+mappings.update( {"street_types" : mapping_street_name,
+                  "tiger_types" : mapping_tiger_type,
+                  "surfaces" : mapping_surface} )
+
+
+# In[ ]:
+
+# check the cleaning on the cached tags table: audit again after cleaning
+# every tag value in one vectorized pass
+cleaned = audit_tables(dict(tables, tags=clean_tags(tables["tags"], **mappings)),
+                       ["tiger:name_type", "tiger:zip_left", "tiger:county", "surface"])
+cleaned["values"]["count"]
 
 
 # In[28]:
 
 # convert file to json
-process_map(file_in, False)
+# (process_map_parallel writes the same file using every cpu core)
+# street names are fixed as they are met, and the audit of the street
+# names is written alongside the json file
+# (output="bson", compress=True writes a .bson.gz file for mongorestore
+# instead, see tools/osm_convert.py)
+process_map(file_in, False, report=file_in + ".streets.json", **mappings)
+
+
+# In[ ]:
+
+# street names fixed during the conversion
+with open(file_in + ".streets.json") as f:
+    streets = json.load(f)
+pprint.pprint(streets["fixed"])
 
 
 # ## MongoDB Import
@@ -470,6 +294,7 @@ process_map(file_in, False)
 # 1. installed mongodb and added binary $PATH
 # 2. mongod --dbpath ./data/db/
 # 3. mongoimport -d openstreetmap -c southbendin --file data-south-bend-indiana.osm.json
+#    (or skip the json file and mongoimport: see load_map below)
 # 4. mongo shell
 #    - show dbs / show collections
 #    - use openstreetmap
@@ -482,14 +307,60 @@ client = MongoClient('localhost:27017')
 db = client.openstreetmap
 
 
+# In[ ]:
+
+# load the cleaned xml straight into MongoDB in batches of 1000 documents
+# (instead of step 3 above); if interrupted, rerunning resumes from the checkpoint
+# ways get the coordinates and bounding box of their nodes, and relations
+# (bus routes, campus boundaries, ...) the bounding box of each member
+# (tools/osm_geometry.py); the counts of users, zip codes, bicycle tags
+# and amenities are kept in southbendin_rollups as it loads (tools/osm_rollups.py)
+# (the same options are used to apply changes below, so the two agree)
+load_options = {"relations": True, "geometry": ("coords", "bbox", "members"),
+                "rollups": True}
+stats = load_map(file_in, db.southbendin, batch_size=1000,
+                 checkpoint=file_in + ".checkpoint", **dict(load_options, **mappings))
+stats
+
+
+# In[ ]:
+
+# apply later OSM updates (daily change files, .osc) on top of the loaded
+# collection instead of reloading the whole map (the ways they change get
+# their geometry from the node index load_map wrote)
+for changes_file in sorted(glob.glob("./changes/*.osc")):
+    print(changes_file, apply_changes(changes_file, db.southbendin, nodes=file_in + ".nodes",
+                                      **dict(load_options, **mappings)))
+
+
+# In[ ]:
+
+# index the fields the queries below filter and group on, then check
+# that each query uses an index (COLLSCAN = full collection scan)
+create_indexes(db.southbendin)
+print_explain_report( explain_report(db.southbendin) )
+
+
 # ## MongoDB Queries
 
+# In[ ]:
+
+# run every query of this section at once on a pool of threads
+# (tools/osm_runner.py): the counts, Notre Dame finds and
+# rankings take about as long as the slowest of them; the summary counts
+# (documents, nodes, ways, users, schools, hospitals) come from one
+# aggregation, cached until the collection changes
+report, timings = run_report(db.southbendin)
+print_timings(timings)
+counts = report["counts"]
+
+
 # ### Number of Documents/Records:
 
 # In[31]:
 
 # number of documents
-db.southbendin.find().count()
+counts["documents"]
 
 
 # ### Number of Nodes:
@@ -497,7 +368,7 @@ db.southbendin.find().count()
 # In[32]:
 
 # number of nodes
-db.southbendin.find({"type":"node"}).count()
+counts["nodes"]
 
 
 # ### Number of Ways:
@@ -505,7 +376,7 @@ db.southbendin.find({"type":"node"}).count()
 # In[33]:
 
 # number of ways
-db.southbendin.find({"type":"way"}).count()
+counts["ways"]
 
 
 # ### Number of Unique Contributing Users:
@@ -513,7 +384,7 @@ db.southbendin.find({"type":"way"}).count()
 # In[34]:
 
 # total unique users
-len( db.southbendin.distinct("created.user") )
+counts["users"]
 
 
 # ### Notre Dame Stadium Information:
@@ -529,9 +400,7 @@ def print_query(x):
 # In[53]:
 
 # test query for Notre Dame Stadium
-query = {"name" : "Notre Dame Stadium"}
-projection = {"_id" : 0, "name" : 1, "operator" : 1, "owner" : 1, "sport" : 1, "start_date" : 1}
-print_query(db.southbendin.find(query, projection))
+print_query( report["notre dame stadium"] )
 
 
 # ### Notre Dame Campus Locations:
@@ -539,9 +408,20 @@ print_query(db.southbendin.find(query, projection))
 # In[37]:
 
 # notre dame
-query = {'name': { "$regex" : ".*Notre.*" } }
+# (names containing "Notre", found with a trigram index of the names
+# instead of a ".*Notre.*" $regex scan; see tools/osm_search.py)
+print_query( report["notre dame"] )
+
+
+# In[ ]:
+
+# university affiliation: tag every node and way inside the campus boundary
+# (most campus buildings do not have "Notre Dame" in their name;
+# see tools/osm_affiliation.py)
+campus = polygons_from_collection(db.southbendin, {"name": "University of Notre Dame"})
+tag_affiliations(db.southbendin, campus)
+query = {"affiliation": "University of Notre Dame", "name": {"$exists": 1}}
 projection = {"_id" : 0, "name" : 1}
-temp = db.southbendin.find(query, projection)
 print_query( db.southbendin.find(query, projection) )
 
 
@@ -550,7 +430,7 @@ print_query( db.southbendin.find(query, projection) )
 # In[38]:
 
 # number of schools
-db.southbendin.find( {"amenity" : "school"} ).count()
+counts["schools"]
 
 
 # ### Number of Hospitals:
@@ -558,7 +438,7 @@ db.southbendin.find( {"amenity" : "school"} ).count()
 # In[39]:
 
 # number of hospitals
-db.southbendin.find( {"amenity" : "hospital"} ).count()
+counts["hospitals"]
 
 
 # ### Top 10 Contributing Users:
@@ -566,10 +446,9 @@ db.southbendin.find( {"amenity" : "hospital"} ).count()
 # In[40]:
 
 # top 10 users
-print_query( db.southbendin.aggregate( [ {"$group": {"_id":"$created.user", "count":{"$sum" : 1} } },
-                                           {"$sort" : {"count" : -1} },
-                                           {"$limit" : 10}
-                                       ] ) )
+# (read from the rollups kept while loading instead of grouping the whole
+# collection; rebuild_rollups recounts them if the data was changed by hand)
+print_query( report["top users"] )
 
 
 # ### Top 10 Zip Codes:
@@ -577,11 +456,7 @@ print_query( db.southbendin.aggregate( [ {"$group": {"_id":"$created.user", "cou
 # In[41]:
 
 # top 10 zip codes
-print_query( db.southbendin.aggregate( [ {"$match" : {"tiger.zip_left" : {"$exists":1}} },
-                                         {"$group": {"_id":"$tiger.zip_left", "count":{"$sum" : 1} } },
-                                         {"$sort" : {"count" : -1} },
-                                         {"$limit" : 10}
-                                       ] ) )
+print_query( report["top zip codes"] )
 
 
 # ### Number of Roads with Bicycle Lanes:
@@ -589,11 +464,7 @@ print_query( db.southbendin.aggregate( [ {"$match" : {"tiger.zip_left" : {"$exis
 # In[42]:
 
 # bicycle lanes
-print_query( db.southbendin.aggregate( [ {"$match" : {"bicycle" : {"$exists":1}} },
-                                         {"$group": {"_id":"$bicycle", "count":{"$sum" : 1} } },
-                                         {"$sort" : {"count" : -1} },
-                                         {"$limit" : 10}
-                                       ] ) )
+print_query( report["bicycle lanes"] )
 
 
 # ### Top 20 Amenities:
@@ -601,35 +472,20 @@ print_query( db.southbendin.aggregate( [ {"$match" : {"bicycle" : {"$exists":1}}
 # In[110]:
 
 # top amenities
-print_query( db.southbendin.aggregate( [ {"$match" : {"amenity" : {"$exists" : 1}} },
-                                         {"$group" : {"_id":"$amenity", "count":{"$sum" : 1}}},
-                                         {"$sort" : {"count": -1}}, {"$limit" : 20}
-                                       ] ) )
+print_query( report["top amenities"] )
 
 
 # ### Distribution of Location Values (Latitude and Longitude Coordinates):
 
-# In[99]:
-
-# extract lat and lon values
-all_loc = db.southbendin.find( {"pos" : { "$exists" : 1 } }, {"pos" : 1} )
-def get_ll(data):
-    x_values = []
-    y_values = []
-    for each in data:
-        x_values.append( each["pos"][0] )
-        y_values.append( each["pos"][1] )
-    return x_values, y_values
-t1,t2 = get_ll(all_loc)
-
-
 # In[109]:
 
 # plot locations
 get_ipython().magic(u'matplotlib inline')
 plt.style.use('ggplot')
-# all locations (blue dots)
-plt.scatter(t1, t2, alpha=0.01)
+# all locations (blue density image: log count of nodes on a 512 x 512 grid,
+# cached in ./tiles until the collection changes)
+grid, extent = density_tile(db.southbendin, bins=512, cache_dir="./tiles")
+plot_density(grid, extent)
 # university of notre dame location (yellow star)
 plt.scatter(41.7030, -86.2390, color = "gold", marker = "*", s=100)
 
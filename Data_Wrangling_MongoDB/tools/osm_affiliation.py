@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+"""
+    University (or any institution) affiliation tags from boundary polygons.
+
+    Most campus buildings do not have the university in their name, so
+    they cannot be found by name. tag_affiliations finds every document
+    whose location falls inside an institution's boundary and sets its
+    affiliation field, for any number of institutions in one pass:
+
+    campus = polygons_from_collection(db.southbendin,
+                                      {"name": "University of Notre Dame"})
+    tag_affiliations(db.southbendin, campus)
+    db.southbendin.find({"affiliation": "University of Notre Dame"})
+
+    A boundary is a list of rings of [lat, lon] points, tested with the
+    even-odd rule, so holes and multipolygons need no special handling.
+    polygons_from_collection reads them from the coords of loaded ways
+    (see osm_geometry) and the outer ways of multipolygon relations;
+    load_polygons reads them from a GeoJSON file.
+
+    The location of a node is its pos and that of a way the center of its
+    bbox; relations, which can span a whole city, are never tagged. All
+    locations are read once into NumPy arrays, straight from the raw
+    BSON cursor batches (see osm_spatial), and bucketed into a uniform
+    grid (PointGrid), so each boundary is only tested against the points
+    in the grid cells its bounding box covers. The test itself is the ray
+    casting point-in-polygon test, vectorized over the points one polygon
+    edge at a time. Matching documents are updated with one
+    update_many per batch_size documents.
+"""
+
+import json
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateMany
+
+from osm_mongo import bump_version
+from osm_spatial import ID_BBOX_DTYPE, ID_POS_DTYPE, iter_layout_batches
+
+
+AFFILIATION_FIELD = "affiliation"
+POINT_QUERY = {"$or": [{"pos": {"$exists": 1}}, {"bbox": {"$exists": 1}}]}
+# relations have a bbox too, but are not places
+POINT_TYPES = ["node", "way"]
+POINTS_PER_CELL = 16
+
+
+def load_polygons(filename, name_property="name"):
+    """ [(name, rings)] for the Polygon and MultiPolygon features of a
+        GeoJSON file, rings as [lat, lon] arrays
+    """
+    with open(filename) as f:
+        features = json.load(f)["features"]
+    institutions = []
+    for feature in features:
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"]
+        if geometry["type"] == "Polygon":
+            polygons = [polygons]
+        # GeoJSON positions are [lon, lat]
+        rings = [np.asarray(ring, dtype=np.float64)[:, ::-1]
+                 for polygon in polygons for ring in polygon]
+        institutions.append((feature["properties"][name_property], rings))
+    return institutions
+
+
+def polygons_from_collection(collection, query):
+    """ [(name, rings)] for the ways and multipolygon relations matching
+        query, from the coords of the ways
+    """
+    institutions = {}
+    # a way can match query and be a member of a relation matching it
+    # too; a ring counted twice would cancel itself out
+    seen = set()
+
+    def add(name, way):
+        if way["id"] not in seen and len(way.get("coords", [])) > 2:
+            seen.add(way["id"])
+            institutions.setdefault(name, []).append(
+                np.asarray(way["coords"], dtype=np.float64))
+
+    projection = {"id": 1, "type": 1, "name": 1, "coords": 1, "members": 1}
+    for doc in collection.find(query, projection):
+        if doc.get("type") == "way":
+            add(doc.get("name"), doc)
+        refs = [m["ref"] for m in doc.get("members", [])
+                if m.get("type") == "way" and m.get("role") in ("outer", "inner", "")]
+        if refs:
+            for way in collection.find({"type": "way", "id": {"$in": refs}},
+                                       {"id": 1, "coords": 1}):
+                add(doc.get("name"), way)
+    return sorted(institutions.items(), key=lambda item: str(item[0]))
+
+
+def document_points(collection, query=POINT_QUERY, batch_size=100000):
+    """ _ids and lat, lon arrays of the location of each node and way;
+        the _ids are raw 12 byte ObjectIds (see object_ids) if they all are
+    """
+    ids = []
+    lat = []
+    lon = []
+    # documents with a pos, then those with only a bbox
+    passes = [("pos", {"type": {"$in": POINT_TYPES}, "pos": {"$exists": 1}}, ID_POS_DTYPE),
+              ("bbox", {"type": {"$in": POINT_TYPES}, "pos": {"$exists": 0},
+                        "bbox": {"$exists": 1}}, ID_BBOX_DTYPE)]
+    for field, located, dtype in passes:
+        for docs in iter_layout_batches(collection, {"$and": [query, located]},
+                                        {"_id": 1, field: 1}, dtype, batch_size):
+            if isinstance(docs, np.ndarray):
+                ids.append(docs["id"])
+                if field == "pos":
+                    points = np.column_stack((docs["pos0"], docs["pos1"]))
+                else:
+                    points = np.column_stack((docs["min0"] + docs["max0"],
+                                              docs["min1"] + docs["max1"])) / 2.0
+            else:
+                # any other layout, decoded document by document
+                ids.append(np.array([doc["_id"] for doc in docs], dtype=object))
+                points = np.array([doc["pos"] if field == "pos" else np.mean(doc["bbox"], axis=0)
+                                   for doc in docs], dtype=np.float64).reshape(-1, 2)
+            lat.append(points[:, 0])
+            lon.append(points[:, 1])
+    if not all(i.dtype.kind == "V" for i in ids):
+        ids = [object_ids(i) for i in ids]
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=object)
+    return ids, np.concatenate(lat or [[]]), np.concatenate(lon or [[]])
+
+
+def object_ids(ids):
+    """ object array of _ids from document_points """
+    if ids.dtype.kind == "V":
+        return np.array([ObjectId(i.tobytes()) for i in ids], dtype=object)
+    return ids
+
+
+class PointGrid(object):
+    """ points bucketed into a uniform grid of about points_per_cell
+        points per cell, for finding the points inside a bounding box
+    """
+
+    def __init__(self, lat, lon, points_per_cell=POINTS_PER_CELL):
+        self.lat = lat
+        self.lon = lon
+        n = len(lat)
+        self.cells = max(1, int(np.sqrt(n / float(points_per_cell))))
+        if n:
+            self.lat_min, self.lat_max = float(lat.min()), float(lat.max())
+            self.lon_min, self.lon_max = float(lon.min()), float(lon.max())
+        else:
+            self.lat_min = self.lat_max = self.lon_min = self.lon_max = 0.0
+        keys = self.cell(lat, self.lat_min, self.lat_max) * self.cells + \
+            self.cell(lon, self.lon_min, self.lon_max)
+        self.order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[self.order]
+
+    def cell(self, values, low, high):
+        """ grid row (lat) or column (lon) of values """
+        width = (high - low) / self.cells or 1.0
+        return np.clip(((np.asarray(values) - low) / width).astype(np.int64), 0, self.cells - 1)
+
+    def candidates(self, lat_min, lon_min, lat_max, lon_max):
+        """ indices of the points inside a bounding box """
+        if not len(self.keys) or lat_max < self.lat_min or lat_min > self.lat_max or \
+                lon_max < self.lon_min or lon_min > self.lon_max:
+            return np.zeros(0, dtype=np.int64)
+        row0, row1 = self.cell([lat_min, lat_max], self.lat_min, self.lat_max)
+        col0, col1 = self.cell([lon_min, lon_max], self.lon_min, self.lon_max)
+        # each grid row is one contiguous run of sorted keys
+        rows = np.arange(row0, row1 + 1) * self.cells
+        starts = np.searchsorted(self.keys, rows + col0, side="left")
+        ends = np.searchsorted(self.keys, rows + col1, side="right")
+        found = np.concatenate([self.order[s:e] for s, e in zip(starts, ends)])
+        lat = self.lat[found]
+        lon = self.lon[found]
+        inside = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+        return found[inside]
+
+
+def points_in_rings(lat, lon, rings):
+    """ boolean array: whether each point is inside the rings (even-odd) """
+    inside = np.zeros(len(lat), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for ring in rings:
+            y = ring[:, 0]
+            x = ring[:, 1]
+            y_prev = np.roll(y, 1)
+            x_prev = np.roll(x, 1)
+            for yi, xi, yj, xj in zip(y, x, y_prev, x_prev):
+                crosses = (yi > lat) != (yj > lat)
+                x_cross = (xj - xi) * (lat - yi) / (yj - yi) + xi
+                inside ^= crosses & (lon < x_cross)
+    return inside
+
+
+def affiliations(grid, institutions):
+    """ index into institutions of the boundary each point of grid falls
+        in, -1 for none; where boundaries overlap the first one wins
+    """
+    labels = np.full(len(grid.lat), -1, dtype=np.int64)
+    for label, (name, rings) in enumerate(institutions):
+        points = np.concatenate(rings)
+        candidates = grid.candidates(points[:, 0].min(), points[:, 1].min(),
+                                     points[:, 0].max(), points[:, 1].max())
+        candidates = candidates[labels[candidates] == -1]
+        inside = points_in_rings(grid.lat[candidates], grid.lon[candidates], rings)
+        labels[candidates[inside]] = label
+    return labels
+
+
+def tag_affiliations(collection, institutions, field=AFFILIATION_FIELD,
+                     query=POINT_QUERY, batch_size=10000):
+    """ set field to the institution's name on every document inside its
+        boundary, removing it from documents no longer inside; returns
+        the number of documents tagged for each institution
+    """
+    ids, lat, lon = document_points(collection, query)
+    labels = affiliations(PointGrid(lat, lon), institutions)
+    names = [name for name, _ in institutions]
+
+    operations = [UpdateMany({field: {"$in": names}}, {"$unset": {field: ""}})]
+    counts = {}
+    for label, name in enumerate(names):
+        tagged = ids[labels == label]
+        counts[name] = len(tagged)
+        for i in range(0, len(tagged), batch_size):
+            batch = list(object_ids(tagged[i:i + batch_size]))
+            operations.append(UpdateMany({"_id": {"$in": batch}},
+                                         {"$set": {field: name}}))
+    try:
+        collection.bulk_write(operations, ordered=True)
+    finally:
+        bump_version(collection)
+    return counts
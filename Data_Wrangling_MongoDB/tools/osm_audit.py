@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+"""
+    Single-pass auditing of an Open Street Map XML file.
+
+    Every audit in the report (tag counts, top users, street types and
+    the raw values of the tags that get cleaned) used to parse the whole
+    file on its own. Here the audits are written as small "auditor"
+    objects that are registered with an AuditEngine, which parses the
+    file once and hands every element to every auditor:
+
+    engine = AuditEngine()
+    engine.register("tags", TagCounter())
+    engine.register("users", UserCounter())
+    engine.register("street_types", StreetTypeAuditor())
+    engine.register("values", TagProfiler(["tiger:county", "surface"]))
+    results = engine.run("data-south-bend-indiana.osm")
+
+    results is a dictionary keyed by the registered names. An auditor is
+    any object with an element(elem) method, called with each element
+    once it has been fully parsed, and a result() method. Elements are
+    freed once every auditor has seen them (see osm_stream), so auditors
+    must copy whatever they want to keep.
+"""
+
+import re
+from collections import defaultdict, Counter
+
+import pandas as pd
+
+from osm_stream import iterparse_clear
+
+
+STREET_TYPE_RE = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+STREET_KEYS = ("addr:street", "name")
+ELEMENT_TAGS = ("node", "way")
+
+
+class AuditEngine(object):
+    """ runs any number of auditors over one parse of an osm file """
+
+    def __init__(self):
+        self.auditors = []
+
+    def register(self, name, auditor):
+        """ add an auditor, its result is returned under name """
+        self.auditors.append((name, auditor))
+        return auditor
+
+    def run(self, filename):
+        """ parse filename once and return {name: auditor result} """
+        handlers = [auditor.element for _, auditor in self.auditors]
+        for element in iterparse_clear(filename):
+            for handler in handlers:
+                handler(element)
+        return dict((name, auditor.result()) for name, auditor in self.auditors)
+
+
+class TagCounter(object):
+    """ number of times each xml tag appears in the file """
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def element(self, elem):
+        self.counts[elem.tag] += 1
+
+    def result(self):
+        return dict(self.counts)
+
+
+class UserCounter(object):
+    """ number of elements contributed by each uid and user name """
+
+    def __init__(self):
+        self.uids = Counter()
+        self.names = Counter()
+
+    def element(self, elem):
+        uid = elem.attrib.get("uid")
+        if uid is not None:
+            self.uids[uid] += 1
+        name = elem.attrib.get("user")
+        if name is not None:
+            self.names[name] += 1
+
+    def result(self):
+        return {"uid": self.uids, "user": self.names}
+
+
+class StreetTypeAuditor(object):
+    """ street names grouped by street type (the last word of the name)
+
+        only street types that are not in expected are kept; with the
+        default of expected=None every street type is kept, so the same
+        audit can be filtered again after the expected list is tuned
+    """
+
+    def __init__(self, expected=None, street_type_re=STREET_TYPE_RE,
+                 keys=STREET_KEYS):
+        self.expected = set(expected or [])
+        self.street_type_re = street_type_re
+        self.keys = keys
+        self.street_types = defaultdict(set)
+
+    def element(self, elem):
+        if elem.tag not in ELEMENT_TAGS:
+            return
+        for tag in elem.iter("tag"):
+            if tag.attrib['k'] in self.keys:
+                street_name = tag.attrib['v']
+                m = self.street_type_re.search(street_name)
+                if m:
+                    street_type = m.group()
+                    if street_type not in self.expected:
+                        self.street_types[street_type].add(street_name)
+
+    def result(self):
+        return self.street_types
+
+
+class MisraGries(object):
+    """ approximate most frequent values in at most k counters
+
+        every value seen more than n / (k + 1) times out of n is kept,
+        and its count is low by at most n / (k + 1)
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+
+    def __getitem__(self, value):
+        return self.counts.get(value, 0)
+
+    def add(self, value):
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+        elif len(counts) < self.k:
+            counts[value] = 1
+        else:
+            # no free counter: decrement them all, dropping those at zero
+            for v in list(counts):
+                if counts[v] == 1:
+                    del counts[v]
+                else:
+                    counts[v] -= 1
+
+    def items(self):
+        return self.counts.items()
+
+
+class TagProfiler(object):
+    """ value counts of any number of tag keys on nodes and ways
+
+        keys is a list of tag keys; top_k maps keys with very many
+        distinct values (such as "name") to the number of counters kept
+        for them, in which case only their approximate top values are
+        counted (see MisraGries). Memory grows with the number of
+        distinct values, never with the number of tags.
+
+        The result is a DataFrame with a (key, value) index and a count
+        column, each key's values sorted by count:
+
+        profile.loc["surface", "count"]  # counts of each surface value
+    """
+
+    def __init__(self, keys, top_k=None, elements=ELEMENT_TAGS):
+        top_k = top_k or {}
+        self.elements = elements
+        self.counters = dict((key, MisraGries(top_k[key]) if key in top_k else Counter())
+                             for key in list(keys) + list(top_k))
+
+    def element(self, elem):
+        if elem.tag not in self.elements:
+            return
+        counters = self.counters
+        for tag in elem.iter("tag"):
+            counter = counters.get(tag.attrib['k'])
+            if counter is None:
+                continue
+            if isinstance(counter, Counter):
+                counter[tag.attrib['v']] += 1
+            else:
+                counter.add(tag.attrib['v'])
+
+    def result(self):
+        rows = []
+        for key in sorted(self.counters):
+            values = sorted(self.counters[key].items(), key=lambda kv: (-kv[1], kv[0]))
+            rows.extend((key, value, count) for value, count in values)
+        profile = pd.DataFrame(rows, columns=["key", "value", "count"])
+        return profile.set_index(["key", "value"])
+
+
+def unexpected_street_types(street_types, expected):
+    """ drop the street types in expected from a StreetTypeAuditor result """
+    return dict((street_type, names) for street_type, names in street_types.items()
+                if street_type not in expected)
@@ -0,0 +1,615 @@
+#!/usr/bin/python
+
+"""
+    Benchmarks for the Open Street Map wrangling tools.
+
+    usage: python osm_benchmark.py <benchmark> <osm file>
+
+    Each benchmark times the way the report used to do something against
+    the tools that replace it and prints one line per variant.
+"""
+
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.cElementTree as ET
+from collections import Counter
+
+from osm_stream import iter_elements
+from osm_convert import (process_map, process_map_parallel, iter_shaped,
+                         FileSink, iter_documents, output_name, orjson)
+from osm_clean import Cleaner, DEFAULT_RULES
+from osm_mongo import load_map
+from osm_streets import StreetNormalizer
+from osm_geometry import build_node_index
+from osm_affiliation import PointGrid, affiliations, document_points, points_in_rings
+from osm_search import TrigramIndex
+from osm_rollups import RollupCounter
+from osm_runner import run_report
+from osm_columnar import columnar_cache, audit_tables, clean_values
+from osm_audit import (AuditEngine, TagCounter, UserCounter,
+                       StreetTypeAuditor, TagProfiler, STREET_TYPE_RE)
+
+
+AUDITED_TAGS = ["tiger:name_type", "tiger:zip_left", "tiger:county", "surface"]
+
+
+def timed(label, func, *args):
+    """ run func(*args), print the elapsed time and return the result """
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    print("{0:<32} {1:8.2f} s".format(label, elapsed))
+    return result
+
+
+# audits as they were written in the report: one full parse each
+
+def legacy_audits(filename):
+    info = {}
+    for _, element in ET.iterparse(filename):
+        info[element.tag] = info.get(element.tag, 0) + 1
+    users = [e.attrib['uid'] for _, e in ET.iterparse(filename) if 'uid' in e.attrib]
+    names = [e.attrib['user'] for _, e in ET.iterparse(filename) if 'user' in e.attrib]
+    street_types = {}
+    for _, elem in ET.iterparse(filename):
+        if elem.tag == "node" or elem.tag == "way":
+            for tag in elem.iter("tag"):
+                if tag.attrib['k'] in ("addr:street", "name"):
+                    m = STREET_TYPE_RE.search(tag.attrib['v'])
+                    if m:
+                        street_types.setdefault(m.group(), set()).add(tag.attrib['v'])
+    values = {}
+    for key in AUDITED_TAGS:
+        values[key] = []
+        for _, elem in ET.iterparse(filename):
+            if elem.tag == "node" or elem.tag == "way":
+                for tag in elem.iter("tag"):
+                    if tag.attrib['k'] == key:
+                        values[key].append(tag.attrib['v'])
+    return info, users, names, street_types, values
+
+
+def single_pass_audits(filename):
+    engine = AuditEngine()
+    engine.register("tags", TagCounter())
+    engine.register("users", UserCounter())
+    engine.register("street_types", StreetTypeAuditor())
+    engine.register("values", TagProfiler(AUDITED_TAGS))
+    return engine.run(filename)
+
+
+def benchmark_audit(filename):
+    """ eight separate parses against one AuditEngine pass """
+    legacy = timed("repeated parses (8)", legacy_audits, filename)
+    single = timed("AuditEngine (1 parse)", single_pass_audits, filename)
+    assert legacy[0] == single["tags"]
+    assert legacy[3] == dict(single["street_types"])
+    for key in AUDITED_TAGS:
+        counts = single["values"].loc[key, "count"]
+        assert Counter(legacy[4][key]) == Counter(dict(counts.items()))
+
+
+# peak memory of a full pass, each variant measured in its own process
+# that imports only what the variant needs: (imports, statement)
+
+MEMORY_VARIANTS = {
+    "ET.iterparse": ("import xml.etree.cElementTree as ET",
+                     "sum(1 for _ in ET.iterparse(filename))"),
+    "iterparse_clear": ("from osm_stream import iterparse_clear",
+                        "sum(1 for _ in iterparse_clear(filename))"),
+    "AuditEngine": ("from osm_audit import AuditEngine, TagCounter, UserCounter, "
+                    "StreetTypeAuditor, TagProfiler",
+                    "engine = AuditEngine()\n"
+                    "engine.register('tags', TagCounter())\n"
+                    "engine.register('users', UserCounter())\n"
+                    "engine.register('street_types', StreetTypeAuditor())\n"
+                    "engine.register('values', TagProfiler({0!r}))\n"
+                    "engine.run(filename)".format(AUDITED_TAGS)),
+    "process_map": ("from osm_convert import process_map", "process_map(filename)"),
+    "node dict": ("from osm_stream import iter_elements",
+                  "len(dict((int(e.attrib['id']), (float(e.attrib['lat']), "
+                  "float(e.attrib['lon']))) for e in iter_elements(filename, ('node',))))"),
+    "NodeIndex": ("import os, tempfile\nfrom osm_geometry import build_node_index",
+                  "len(build_node_index(filename, os.path.join(tempfile.mkdtemp(), 'nodes')))"),
+}
+
+# peak rss in kilobytes: VmHWM on Linux, where ru_maxrss keeps the peak
+# of the process that forked this one; ru_maxrss is in bytes on macOS
+PEAK_RSS = """
+import os, resource, sys
+sys.path.insert(0, {tools!r})
+
+def peak():
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+{imports}
+filename = sys.argv[1]
+before = peak()
+{statement}
+print(before, peak())
+"""
+
+
+def benchmark_memory(filename):
+    """ peak rss of ET.iterparse against the streaming reader, less the
+        rss of the imports (shown apart)
+    """
+    size = os.path.getsize(filename) / 1024.0 ** 2
+    tools = os.path.dirname(os.path.abspath(__file__))
+    print("{0:<32} {1:8.1f} MB".format("file size", size))
+    for variant in sorted(MEMORY_VARIANTS):
+        imports, statement = MEMORY_VARIANTS[variant]
+        script = PEAK_RSS.format(tools=tools, imports=imports, statement=statement)
+        out = subprocess.check_output([sys.executable, "-c", script, filename])
+        before, after = [int(v) / 1024.0 for v in out.split()[-2:]]
+        print("{0:<32} {1:8.1f} MB  ({2:.2f} x file size, imports {3:.1f} MB)".format(
+            variant, after - before, (after - before) / size, before))
+
+
+def benchmark_parallel(filename):
+    """ process_map against process_map_parallel on 1..n cores (see
+        osm_tests.test_parallel for the check that they agree)
+    """
+    timed("process_map", process_map, filename)
+    processes = 1
+    while processes <= multiprocessing.cpu_count():
+        timed("process_map_parallel ({0})".format(processes),
+              process_map_parallel, filename, False, processes)
+        processes *= 2
+
+
+# shape_element as it was written in the report, for comparison
+
+def legacy_shape_element(element, updates_street_names, mapping_tiger_type, mapping_surface):
+    CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
+    problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+    node = {}
+    if element.tag == "node" or element.tag == "way" :
+        created = {}
+        address = {}
+        tiger = {}
+        gnis = {}
+        for x in element.attrib:
+            if x in CREATED:
+                created[x] = element.attrib[x]
+            elif x == "lat":
+                lat = float( element.attrib.get("lat") )
+            elif x == "lon":
+                lon = float( element.attrib.get("lon") )
+            else:
+                node[x] = element.attrib[x]
+        node["type"] = element.tag
+        if len(created) > 0:
+            node["created"] = created
+        try:
+            node["pos"] = [lat, lon]
+        except:
+            pass
+        for tag in element.iter("tag"):
+            tag_key = tag.attrib['k']
+            tag_value = tag.attrib['v']
+            if tag_value in list(updates_street_names.keys()):
+                tag_value = updates_street_names[tag_value]
+            if tag_value in list(mapping_tiger_type.keys()):
+                tag_value = mapping_tiger_type[tag_value]
+            if tag_key == "tiger:zip_left" or tag_key == "tiger:zip_right" :
+                tag_value = tag_value[:5]
+            if tag_key == "tiger:county":
+                if ':' in tag_value or ';' in tag_value:
+                    edit = str.replace(tag_value, ";",":")
+                    tag_value = edit.split(':')[0]
+            if tag_key == "surface":
+                if tag_value in list(mapping_surface.keys()):
+                    tag_value = mapping_surface[tag_value]
+            if problemchars.match(tag_key):
+                pass
+            elif tag_key.count(":") > 1:
+                pass
+            elif tag_key.startswith("addr:"):
+                address[ tag_key.split(":")[1] ] = tag_value
+            elif tag_key.startswith("tiger:"):
+                tiger[ tag_key.split(":")[1] ] = tag_value
+            elif tag_key.startswith("gnis:"):
+                gnis[ tag_key.split(":")[1] ] = tag_value
+            else:
+                node[tag_key] = tag_value
+        if len(address) > 0:
+            node["address"] = address
+        if len(tiger) > 0:
+            node["tiger"] = tiger
+        if len(gnis) > 0:
+            node["gnis"] = gnis
+        refs = []
+        for nd in element.iter("nd"):
+            refs.append( nd.attrib['ref'] )
+        if len(refs) > 0:
+            node["node_refs"] = refs
+        return node
+    else:
+        return None
+
+
+# the report's cleaning mappings, with the street name fixes for South Bend
+STREET_MAPPING = {"Ave": "Avenue", "Blvd": "Boulevard", "Blvd.": "Boulevard", "Dr": "Drive",
+                  "Pky": "Parkway", "Rd": "Road", "St": "Street", "Ln": "Lane",
+                  "Cir": "Circle", "Crt": "Court", "Ct": "Court", "Tr": "Trail",
+                  "Trl": "Trail"}
+
+
+# the street name fixes as the report worked them out, for legacy_shape_element
+LEGACY_STREET_NAMES = {"Angela Blvd.": "Angela Boulevard", "Eddy St": "Eddy Street",
+                       "Edison Rd": "Edison Road", "Ironwood Dr": "Ironwood Drive",
+                       "Juniper Rd": "Juniper Road", "St Joseph Ct": "St Joseph Court",
+                       "Lincoln Ave": "Lincoln Avenue", "Main St": "Main Street",
+                       "Oak Ln": "Oak Lane", "Pine Cir": "Pine Circle",
+                       "Portage Trl": "Portage Trail", "Stadium Crt": "Stadium Court"}
+
+
+REPORT_MAPPINGS = {
+    "street_types": STREET_MAPPING,
+    "tiger_types": {"Ave:Blvd": "Avenue", "Ave:Rd": "Boulevard", "Blvd:Rd": "Road",
+                    "Blvd:St": "Boulevard", "Cir:Rd": "Circle", "Cir; Way": "Circle",
+                    "Ct;Ln": "Lane", "Dr:Rd": "Drive", "Rd; Hwy": "Highway",
+                    "St": "Street", "Dr": "Drive", "Rd": "Road", "Ct": "Court",
+                    "Cir": "Circle", "Crt": "Court", "Ave": "Avenue", "Ln": "Lane",
+                    "Blvd": "Boulevard", "Blvd.": "Boulevard", "Tr": "Trail",
+                    "Trl": "Trail", "Pl": "Place", "Pky": "Parkway", "Hwy": "Highway",
+                    "Aly": "Alley", "Sq": "Square", "Cv": "Cove", "Cres": "Crescent",
+                    "Xing": "Crossing", "Ter": "Terrace", "Trce": "Trace",
+                    "Plz": "Plaza", "Brg": "Bridge"},
+    "surfaces": {"paved,_gravel": "gravel", "fine_gravel": "gravel", "dirt": "ground",
+                 "grass": "ground", "earth": "ground", "compacted": "ground"},
+}
+
+
+def load_elements(filename):
+    """ every node and way in filename, kept in memory for timing """
+    return [elem for elem in ET.parse(filename).getroot() if elem.tag in ("node", "way")]
+
+
+def benchmark_shape(filename):
+    """ per-element time and tags/sec of legacy_shape_element against
+        Cleaner.shape, which only cleans each tag with its own key's rule
+    """
+    elements = load_elements(filename)
+    tags = sum(len(e.findall("tag")) for e in elements)
+    m = REPORT_MAPPINGS
+
+    def legacy():
+        return [legacy_shape_element(e, LEGACY_STREET_NAMES, m["tiger_types"],
+                                     m["surfaces"]) for e in elements]
+
+    def cleaner():
+        shape = Cleaner(**m).shape
+        return [shape(e) for e in elements]
+
+    start = time.time()
+    before = legacy()
+    legacy_time = time.time() - start
+    start = time.time()
+    after = cleaner()
+    cleaner_time = time.time() - start
+    assert [d["id"] for d in before] == [d["id"] for d in after]
+    changed = sum(1 for a, b in zip(before, after) if a != b)
+    for label, elapsed in (("shape_element", legacy_time), ("Cleaner.shape", cleaner_time)):
+        print("{0:<32} {1:8.2f} us/element {2:10.0f} tags/s".format(
+            label, 1e6 * elapsed / len(elements), tags / elapsed))
+    print("{0:<32} {1:8.2f} x".format("speedup", legacy_time / cleaner_time))
+    print("{0:<32} {1:8d}".format("documents cleaned differently", changed))
+
+
+def benchmark_collection():
+    """ a collection on a local mongod, or an in-process mongomock one """
+    try:
+        from pymongo import MongoClient
+        client = MongoClient("localhost:27017", serverSelectionTimeoutMS=1000)
+        client.server_info()
+        label = "mongod"
+    except Exception:
+        import mongomock
+        client = mongomock.MongoClient()
+        label = "mongomock"
+    collection = client.osm_benchmark.southbendin
+    collection.drop()
+    return label, collection
+
+
+def benchmark_load(filename):
+    """ documents/sec of load_map for a few batch sizes """
+    label, collection = benchmark_collection()
+    for batch_size in (100, 1000, 10000):
+        for max_pending in (None, 4):
+            collection.drop()
+            stats = load_map(filename, collection, batch_size,
+                             max_pending=max_pending, **REPORT_MAPPINGS)
+            print("{0:<32} {1:8.0f} docs/s".format("{0} batch={1} pending={2}".format(
+                label, batch_size, max_pending), stats["docs_per_sec"]))
+    collection.drop()
+
+
+def benchmark_columnar(filename):
+    """ audits re-parsing the xml against audits over the columnar cache """
+    timed("AuditEngine (1 parse)", single_pass_audits, filename)
+    timed("columnar_cache (build)", columnar_cache, filename, None, True)
+    tables = timed("columnar_cache (load)", columnar_cache, filename)
+    timed("audit_tables", audit_tables, tables, AUDITED_TAGS)
+
+
+def benchmark_clean(filename):
+    """ per-tag cleaning against clean_values (see
+        osm_tests.test_clean_values for the check that they agree)
+    """
+    import pandas as pd
+    tags = columnar_cache(filename)["tags"]
+    key_rules = Cleaner(**REPORT_MAPPINGS).key_rules
+    columns = [(key, tags["v"][(tags["k"] == key).values].astype(object))
+               for key in sorted(DEFAULT_RULES)]
+    # repeat the values so that the timings are not all overhead
+    columns = [(key, pd.Series(v.tolist() * max(1, 1000000 // (len(v) or 1))))
+               for key, v in columns if len(v)]
+    n = sum(len(v) for _, v in columns)
+
+    def per_tag():
+        return [[key_rules[key](x) for x in v] for key, v in columns]
+
+    def vectorized():
+        return [clean_values(v, key, **REPORT_MAPPINGS) for key, v in columns]
+
+    for label, func in (("per tag", per_tag), ("clean_values", vectorized)):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        print("{0:<32} {1:8.2f} s {2:12.0f} values/s".format(label, elapsed, n / elapsed))
+
+
+def legacy_update_street(name, mapping):
+    """ update_street as it was written in the report """
+    m = STREET_TYPE_RE.search(name)
+    if m:
+        x = m.group()
+        new = name.replace(x, mapping[x])
+    return new
+
+
+def benchmark_streets(filename):
+    """ regex + str.replace against StreetNormalizer over every street name
+        in the file, with the normalizer's cache hit rate
+    """
+    tables = columnar_cache(filename)
+    tags = tables["tags"]
+    names = tags["v"][tags["k"].isin(["addr:street", "name"]).values].astype(object).tolist()
+
+    def legacy():
+        fixed = []
+        for name in names:
+            try:
+                fixed.append(legacy_update_street(name, STREET_MAPPING))
+            except Exception:
+                fixed.append(name)
+        return fixed
+
+    normalize = StreetNormalizer(STREET_MAPPING)
+    before = timed("update_street", legacy)
+    start = time.time()
+    after = timed("StreetNormalizer", lambda: [normalize(name) for name in names])
+    elapsed = time.time() - start
+    stats = normalize.stats()
+    print("{0:<32} {1:8d}".format("names", stats["calls"]))
+    print("{0:<32} {1:8d}".format("distinct names", stats["misses"]))
+    print("{0:<32} {1:8.1%}".format("cache hit rate", stats["hit_rate"]))
+    print("{0:<32} {1:8.0f} names/s".format("throughput",
+                                            len(names) / elapsed if elapsed > 0 else 0.0))
+    print("{0:<32} {1:8d}".format("names fixed differently",
+                                  sum(1 for a, b in zip(before, after) if a != b)))
+
+
+def write_compressed(filename, directory):
+    """ gz, bz2, xz, and multi-stream bz2 copies of filename, with the
+        (label, path) of each, the uncompressed file first
+    """
+    import bz2
+    import gzip
+    import lzma
+    with open(filename, "rb") as f:
+        raw = f.read()
+    name = os.path.join(directory, os.path.basename(filename))
+    copies = [("xml", filename)]
+    for ext, compress in ((".gz", gzip.compress), (".bz2", bz2.compress),
+                          (".xz", lzma.compress)):
+        with open(name + ext, "wb") as f:
+            f.write(compress(raw))
+        copies.append((ext[1:], name + ext))
+    # what pbzip2 writes: one stream per 900k block
+    step = 900000
+    with open(name + ".multi.bz2", "wb") as f:
+        for i in range(0, len(raw), step):
+            f.write(bz2.compress(raw[i:i + step]))
+    copies.append(("bz2 multi-stream", name + ".multi.bz2"))
+    return copies
+
+
+def benchmark_compressed(filename):
+    """ size and elements/s of iter_elements over compressed copies """
+    directory = tempfile.mkdtemp()
+    try:
+        xml_bytes = os.path.getsize(filename)
+        for label, path in write_compressed(filename, directory):
+            start = time.time()
+            for _ in iter_elements(path):
+                pass
+            elapsed = time.time() - start
+            print("{0:<20} {1:8.1f} MB {2:6.1f}x {3:8.2f} s {4:8.1f} MB/s xml".format(
+                label, os.path.getsize(path) / 1e6, float(xml_bytes) / os.path.getsize(path),
+                elapsed, xml_bytes / 1e6 / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_output(filename):
+    """ write time, size, and reload time of each output format """
+    docs = list(iter_shaped(filename, **REPORT_MAPPINGS))
+    directory = tempfile.mkdtemp()
+    name = os.path.join(directory, os.path.basename(filename))
+    print("fast-json encoder: {0}".format("orjson" if orjson else "json (orjson not installed)"))
+    try:
+        for output in ("json", "fast-json", "bson"):
+            for compress in (False, True):
+                path = output_name(name, output, compress)
+                start = time.time()
+                sink = FileSink(path, output)
+                for el in docs:
+                    sink.write(el)
+                sink.close()
+                write = time.time() - start
+                start = time.time()
+                reloaded = sum(1 for _ in iter_documents(path))
+                reload = time.time() - start
+                assert reloaded == len(docs)
+                print("{0:<20} write {1:6.2f} s {2:8.1f} MB  reload {3:6.2f} s".format(
+                    output + (".gz" if compress else ""), write,
+                    os.path.getsize(path) / 1e6, reload))
+                os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_geometry(filename):
+    """ process_map with and without way geometry, and NodeIndex lookups """
+    timed("process_map", process_map, filename)
+    timed("process_map geometry", lambda: process_map(filename, geometry=("coords", "bbox")))
+    directory = tempfile.mkdtemp()
+    try:
+        index = timed("build_node_index", build_node_index, filename,
+                      os.path.join(directory, "nodes"))
+        ways = [[int(nd.attrib["ref"]) for nd in e.iter("nd")]
+                for e in iter_elements(filename, ("way",))]
+        start = time.time()
+        for refs in ways:
+            index.lookup(refs)
+        elapsed = time.time() - start
+        print("{0:<32} {1:8d} nodes".format("index size", len(index)))
+        print("{0:<32} {1:8.0f} ways/s".format("NodeIndex.lookup", len(ways) / elapsed))
+        del index
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_affiliation(filename, points=2000000, institutions=20):
+    """ reading the locations of the file's documents back from the
+        database, then point-in-polygon tagging with the grid against
+        testing every point, over the file's node positions (jittered up
+        to points)
+    """
+    import numpy as np
+    label, collection = benchmark_collection()
+    load_map(filename, collection, geometry=("bbox",), **REPORT_MAPPINGS)
+    ids, _, _ = timed("document_points ({0})".format(label), document_points, collection)
+    print("{0:<32} {1:8d}".format("documents located", len(ids)))
+    collection.drop()
+    nodes = columnar_cache(filename)["nodes"]
+    rnd = np.random.RandomState(0)
+    pick = rnd.randint(0, len(nodes), points)
+    lat = nodes["lat"].values[pick] + rnd.normal(0, 0.001, points)
+    lon = nodes["lon"].values[pick] + rnd.normal(0, 0.001, points)
+    # star shaped campuses of 200 edges, each with a hole
+    t = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+    polygons = []
+    for k in range(institutions):
+        i = rnd.randint(points)
+        r = 0.005 + 0.003 * np.abs(np.sin(5 * t))
+        polygons.append(("institution {0}".format(k), [
+            np.column_stack((lat[i] + r * np.cos(t), lon[i] + r * np.sin(t))),
+            np.column_stack((lat[i] + 0.001 * np.cos(t), lon[i] + 0.001 * np.sin(t)))]))
+    labels = timed("PointGrid + affiliations", lambda: affiliations(PointGrid(lat, lon), polygons))
+
+    def every_point():
+        found = np.full(points, -1)
+        for k, (_, rings) in enumerate(polygons):
+            found[(found == -1) & points_in_rings(lat, lon, rings)] = k
+        return found
+    expected = timed("every point", every_point)
+    print("{0:<32} {1:8d}".format("points tagged", int((labels >= 0).sum())))
+    print("{0:<32} {1:8d}".format("labels differing", int((labels != expected).sum())))
+
+
+def benchmark_search(filename, queries=("Notre", "Street", "Dame Ave", "Hall")):
+    """ an unanchored regex over every document's name against the trigram
+        index of the distinct names (see osm_tests.test_search for the check
+        that both find the same names)
+    """
+    names = [el["name"] for el in iter_shaped(filename, **REPORT_MAPPINGS)
+             if isinstance(el.get("name"), type(u""))]
+    values = sorted(set(names))
+    index = timed("TrigramIndex.build", TrigramIndex.build, values, [1] * len(values))
+    print("{0:<32} {1:8d} / {2}".format("distinct names / names", len(values), len(names)))
+    for text in queries:
+        regex = re.compile(".*" + re.escape(text) + ".*")
+        start = time.time()
+        [name for name in names if regex.match(name)]
+        scan = time.time() - start
+        start = time.time()
+        found = set(index.substring(text))
+        lookup = time.time() - start
+        print("{0:<32} {1:8.3f} ms regex {2:8.3f} ms index ({3} names)".format(
+            repr(text), scan * 1000, lookup * 1000, len(found)))
+
+
+def benchmark_rollups(filename):
+    """ process_map alone and with a RollupCounter sink, which is the
+        whole cost of keeping the rollups while converting
+    """
+    timed("process_map", lambda: process_map(filename, **REPORT_MAPPINGS))
+    counter = RollupCounter()
+    sinks = [FileSink(output_name(filename)), counter]
+    timed("process_map + RollupCounter",
+          lambda: process_map(filename, sinks=sinks, **REPORT_MAPPINGS))
+    for name, counts in sorted(counter.counts.items()):
+        print("{0:<32} {1:8d} values".format(name, len(counts)))
+
+
+def benchmark_report(filename):
+    """ the report's queries one at a time against run_report's pool, on
+        the documents of filename (the rollups are only kept on a mongod)
+    """
+    label, collection = benchmark_collection()
+    load_map(filename, collection, rollups=label == "mongod", **REPORT_MAPPINGS)
+    # the first run builds the name index (see osm_search)
+    run_report(collection)
+    results, sequential = run_report(collection, max_workers=1)
+    concurrent_results, concurrent = run_report(collection)
+    assert concurrent_results == results
+    for name, timings in (("one at a time", sequential), ("run_report", concurrent)):
+        print("{0:<32} {1:8.1f} ms total {2:8.1f} ms slowest".format(
+            "{0} {1}".format(label, name), timings["total"] * 1000,
+            max(v for k, v in timings.items() if k != "total") * 1000))
+    collection.drop()
+
+
+BENCHMARKS = {"audit": benchmark_audit, "memory": benchmark_memory,
+              "parallel": benchmark_parallel, "shape": benchmark_shape,
+              "load": benchmark_load, "columnar": benchmark_columnar,
+              "clean": benchmark_clean, "streets": benchmark_streets,
+              "compressed": benchmark_compressed, "output": benchmark_output,
+              "geometry": benchmark_geometry, "affiliation": benchmark_affiliation,
+              "search": benchmark_search, "rollups": benchmark_rollups,
+              "report": benchmark_report}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        print("benchmarks: " + ", ".join(sorted(BENCHMARKS)))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](sys.argv[2])
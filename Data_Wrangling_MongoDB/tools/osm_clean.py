@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+"""
+    Cleaning and shaping of Open Street Map elements.
+
+    A Cleaner is built once from the report's cleaning mappings and then
+    shapes any number of node/way elements into MongoDB documents:
+
+    cleaner = Cleaner(street_types=mapping_street_name,
+                      tiger_types=mapping_tiger_type,
+                      surfaces=mapping_surface)
+    doc = cleaner.shape(element)
+
+    Cleaning is driven by a rule table keyed by tag key, so each tag only
+    goes through the cleaning step for its own key, found with a single
+    dictionary lookup. A rule is a dictionary naming one of RULE_TYPES
+    and its arguments; "map" rules name one of the mappings:
+
+    {"addr:street": {"rule": "street", "mapping": "street_types"},
+     "tiger:zip_left": {"rule": "truncate", "length": 5},
+     "tiger:county": {"rule": "first", "delimiters": ";:"}}
+
+    "street" rules fix street names as they are met during the
+    conversion, with a StreetNormalizer (see osm_streets) that replaces
+    the last word of a name found in the mapping of street types, so the
+    fixes for each name do not have to be worked out beforehand. The
+    normalizer audits the names as a by-product; Cleaner.report() merges
+    the audits of every street rule into the names counted by street type
+    and every name that was fixed.
+
+    DEFAULT_RULES are the five cleaning steps of the report. Rules and
+    mappings for another city can be kept in a json file (see
+    rules/south_bend.json) and loaded with load_rules, whose result is
+    passed straight to Cleaner or process_map:
+
+    mappings = load_rules("tools/rules/south_bend.json")
+    process_map(file_in, **mappings)
+
+    Relations (bus routes, multipolygon boundaries, ...) are only shaped
+    when the Cleaner is built with relations=True, which process_map and
+    load_map pass through with the mappings.
+
+    Everything that does not depend on the element is done up front: the
+    regular expressions are compiled, the rules are turned into functions,
+    and the way each tag key is stored (top level, address, tiger, gnis,
+    or ignored) is worked out the first time the key is seen.
+"""
+
+import json
+import re
+
+from osm_streets import StreetNormalizer, merge_reports
+
+
+CREATED = frozenset([ "version", "changeset", "timestamp", "user", "uid"])
+PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+SUBDOCUMENTS = ("addr:", "tiger:", "gnis:")
+SUBDOCUMENT_NAMES = {"addr:": "address", "tiger:": "tiger", "gnis:": "gnis"}
+STREET_CACHE_SIZE = 100000
+
+DEFAULT_RULES = {
+    # CLEAN DATA STEP 1 - street names (addr:street and name)
+    "addr:street": {"rule": "street", "mapping": "street_types"},
+    "name": {"rule": "street", "mapping": "street_types"},
+    # CLEAN DATA STEP 2 - tiger street type (tiger:name_type)
+    "tiger:name_type": {"rule": "map", "mapping": "tiger_types"},
+    # CLEAN DATA STEP 3 - zip codes, if multiple only use the first
+    "tiger:zip_left": {"rule": "truncate", "length": 5},
+    "tiger:zip_right": {"rule": "truncate", "length": 5},
+    # CLEAN DATA STEP 4 - county names, if multiple only use the first
+    "tiger:county": {"rule": "first", "delimiters": ";:"},
+    # CLEAN DATA STEP 5 - road surfaces (surface)
+    "surface": {"rule": "map", "mapping": "surfaces"},
+}
+
+
+def map_rule(mapping):
+    """ replace values found in mapping, keep all others """
+    get = mapping.get
+
+    def clean(value):
+        return get(value, value)
+    return clean
+
+
+def truncate_rule(length):
+    """ keep the first length characters """
+    def clean(value):
+        return value[:length]
+    return clean
+
+
+def first_rule(delimiters):
+    """ keep the text before the first of any of the delimiters """
+    def clean(value):
+        end = len(value)
+        for d in delimiters:
+            i = value.find(d)
+            if 0 <= i < end:
+                end = i
+        return value[:end]
+    return clean
+
+
+def street_rule(mapping, cache_size=STREET_CACHE_SIZE):
+    """ replace the street type (last word) of names, if in mapping """
+    return StreetNormalizer(mapping, cache_size)
+
+
+RULE_TYPES = {"map": map_rule, "truncate": truncate_rule, "first": first_rule,
+              "street": street_rule}
+
+
+def check_mappings(rules, mappings):
+    """ raise TypeError for mappings no rule names (a misspelled mapping,
+        or an option meant for something else, would otherwise be
+        silently ignored)
+    """
+    known = set(rule["mapping"] for rule in rules.values() if "mapping" in rule)
+    unknown = sorted(set(mappings) - known)
+    if unknown:
+        raise TypeError("unknown mapping(s) {0}; the rules use {1}".format(
+            ", ".join(unknown), ", ".join(sorted(known))))
+
+
+def build_rule(rule, mappings):
+    """ cleaning function for one rule of a rule table """
+    if rule["rule"] not in RULE_TYPES:
+        raise ValueError("unknown rule type {0!r}".format(rule["rule"]))
+    args = dict((k, v) for k, v in rule.items() if k != "rule")
+    if "mapping" in args:
+        args["mapping"] = mappings.get(args["mapping"]) or {}
+    return RULE_TYPES[rule["rule"]](**args)
+
+
+def load_rules(filename):
+    """ rules and mappings from a json file, as keyword arguments for
+        Cleaner: {"rules": {...}, "street_types": {...}, ...}
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    mappings = dict(config.get("mappings", {}))
+    mappings["rules"] = config.get("rules", DEFAULT_RULES)
+    return mappings
+
+
+def classify_key(tag_key):
+    """ (sub-document, field) a tag key is stored under, or None if the
+        tag is dropped; the sub-document is None for top level fields
+    """
+    # ignore tags with problem characters
+    if PROBLEMCHARS.match(tag_key):
+        return None
+    # ignore tags with multiple colons
+    if tag_key.count(":") > 1:
+        return None
+    # tags with addr:, tiger:, or gnis:
+    for prefix in SUBDOCUMENTS:
+        if tag_key.startswith(prefix):
+            return SUBDOCUMENT_NAMES[prefix], tag_key.split(":")[1]
+    # all other tags
+    return None, tag_key
+
+
+class Cleaner(object):
+    """ shapes node and way elements, cleaning tag values by key
+
+        mappings are the dictionaries named by "map" and "street" rules,
+        for the default rules: street_types, tiger_types, and surfaces;
+        relations=True also shapes relation elements, with their members
+        as a list of {"type", "ref", "role"} dictionaries; a type tag
+        (multipolygon, route, ...) never replaces the document type and
+        is stored as relation_type, way_type, or node_type
+    """
+
+    def __init__(self, rules=None, relations=False, **mappings):
+        self.relations = relations
+        if rules is None:
+            rules = DEFAULT_RULES
+        check_mappings(rules, mappings)
+        # keys with the same rule share one cleaning function (and one
+        # street name cache)
+        built = {}
+        self.key_rules = {}
+        for key, rule in rules.items():
+            name = json.dumps(rule, sort_keys=True)
+            if name not in built:
+                built[name] = build_rule(rule, mappings)
+            self.key_rules[key] = built[name]
+        self.keys = {}
+
+    def report(self):
+        """ audit of the street names cleaned so far by every street rule,
+            merged (see osm_streets), {} if no rule is a street rule
+        """
+        normalizers = []
+        for key in sorted(self.key_rules):
+            rule = self.key_rules[key]
+            if isinstance(rule, StreetNormalizer) and rule not in normalizers:
+                normalizers.append(rule)
+        if not normalizers:
+            return {}
+        return merge_reports([rule.report() for rule in normalizers])
+
+    def shape(self, element):
+        """ document for a node or way element (and relation elements if
+            relations is set), None for anything else
+        """
+        if element.tag != "node" and element.tag != "way":
+            if element.tag != "relation" or not self.relations:
+                return None
+
+        node = {}
+        created = {}
+        pos = [None, None]
+
+        # iterate over all attributes
+        for x, value in element.attrib.items():
+            if x in CREATED:
+                created[x] = value
+            elif x == "lat":
+                pos[0] = float(value)
+            elif x == "lon":
+                pos[1] = float(value)
+            else:
+                node[x] = value
+
+        # add type, created if not empty, and position if it exists
+        node["type"] = element.tag
+        if created:
+            node["created"] = created
+        if pos[0] is not None and pos[1] is not None:
+            node["pos"] = pos
+
+        # parse tags
+        key_rules = self.key_rules
+        keys = self.keys
+        subdocuments = {}
+        for tag in element.iter("tag"):
+            tag_key = tag.attrib['k']
+            tag_value = tag.attrib['v']
+            rule = key_rules.get(tag_key)
+            if rule is not None:
+                tag_value = rule(tag_value)
+            try:
+                target = keys[tag_key]
+            except KeyError:
+                target = keys[tag_key] = classify_key(tag_key)
+            if target is None:
+                continue
+            subdocument, field = target
+            if subdocument is None:
+                if field == "type":
+                    # documents are found by their element type and id
+                    field = element.tag + "_type"
+                node[field] = tag_value
+            else:
+                subdocuments.setdefault(subdocument, {})[field] = tag_value
+
+        # add address, tiger, and gnis sub-dictionaries if not empty
+        for name in ("address", "tiger", "gnis"):
+            if name in subdocuments:
+                node[name] = subdocuments[name]
+
+        # add refs
+        refs = [nd.attrib['ref'] for nd in element.iter("nd")]
+        if refs:
+            node["node_refs"] = refs
+
+        # add relation members
+        members = [dict(m.attrib) for m in element.iter("member")]
+        if members:
+            node["members"] = members
+        return node
@@ -0,0 +1,418 @@
+#!/usr/bin/python
+
+"""
+    Parse-once columnar cache of an Open Street Map XML file.
+
+    columnar_cache parses the file once into six tables (nodes, ways,
+    relations, tags, nds, and members) stored on disk next to it, and
+    afterwards loads them as pandas DataFrames without touching the XML:
+
+    tables = columnar_cache("data-south-bend-indiana.osm")
+    tables["tags"]  # element, id, k, v: one row per <tag>
+    tables["nds"]   # way_id, ref, seq: one row per <nd>
+
+    Everything else in the file (the root <osm>, <bounds>, ...) is only
+    counted: tables["others"] has the element and count of every other tag.
+
+    The tables are written as Parquet files when pyarrow is installed.
+    Without it every column is a NumPy memory map (a raw .bin file), with
+    string columns dictionary encoded as int32 codes plus a json list of
+    the distinct values, loaded back as pandas Categoricals.
+
+    The cache directory has a manifest.json recording the size, mtime,
+    and sha1 hash of the source file. If the size or the mtime of the
+    source no longer match, the hash is computed again and the tables
+    are rebuilt when it has changed.
+
+    audit_tables runs the report's audits (tag counts, users, street
+    types, and value counts) as vectorized pandas operations over the
+    tables, returning the same dictionary as the AuditEngine in osm_audit.
+
+    The cleaning rules of osm_clean have vectorized versions as well:
+    clean_values cleans a whole column of values of one key with .map,
+    .str.slice, .str.replace, and .str.rpartition, with the same results as the Cleaner;
+    clean_tags cleans every row of a tags table; and clean_value_counts
+    turns the value counts of one key into the counts after cleaning.
+
+    tables["tags"] = clean_tags(tables["tags"], **mappings)
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+from collections import Counter, defaultdict
+
+import numpy as np
+import pandas as pd
+
+from osm_stream import iterparse, ELEMENT_TAGS
+from osm_audit import STREET_TYPE_RE, STREET_KEYS
+from osm_clean import DEFAULT_RULES, check_mappings
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+ATTRIBUTE_COLUMNS = [("id", "int64"), ("version", "int32"), ("changeset", "int64"),
+                     ("timestamp", "datetime64[s]"), ("uid", "int64"), ("user", "str")]
+
+TABLES = {
+    "nodes": ATTRIBUTE_COLUMNS + [("lat", "float64"), ("lon", "float64")],
+    "ways": ATTRIBUTE_COLUMNS,
+    "relations": ATTRIBUTE_COLUMNS,
+    "tags": [("element", "str"), ("id", "int64"), ("k", "str"), ("v", "str")],
+    "nds": [("way_id", "int64"), ("ref", "int64"), ("seq", "int32")],
+    "members": [("relation_id", "int64"), ("type", "str"), ("ref", "int64"),
+                ("role", "str")],
+}
+ELEMENT_TABLES = {"node": "nodes", "way": "ways", "relation": "relations"}
+CHUNK_ROWS = 500000
+MANIFEST = "manifest.json"
+
+
+def column_array(values, dtype):
+    """ numpy array of one chunk of a column (strings stay a list) """
+    if dtype == "str":
+        return values
+    if dtype.startswith("datetime64"):
+        # OSM timestamps are ISO 8601 in UTC: 2012-03-28T18:31:23Z
+        return np.array([v.rstrip("Z") for v in values], dtype=dtype)
+    return np.array(values, dtype=dtype)
+
+
+class ParquetTableWriter(object):
+    """ appends chunks of rows to one Parquet file, a row group each """
+
+    def __init__(self, path, columns):
+        self.path = path + ".parquet"
+        self.columns = columns
+        self.writer = None
+
+    def write(self, chunk):
+        arrays = [pa.array(column_array(chunk[name], dtype)) for name, dtype in self.columns]
+        table = pa.Table.from_arrays(arrays, names=[name for name, _ in self.columns])
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self, rows):
+        if self.writer is None:
+            chunk = dict((name, []) for name, _ in self.columns)
+            self.write(chunk)
+        self.writer.close()
+        return {"format": "parquet", "file": os.path.basename(self.path), "rows": rows}
+
+
+class MemmapTableWriter(object):
+    """ appends chunks of rows to one raw binary file per column """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.vocab = dict((name, {}) for name, dtype in columns if dtype == "str")
+        self.files = dict((name, open("{0}.{1}.bin".format(path, name), "wb"))
+                          for name, _ in columns)
+
+    def write(self, chunk):
+        for name, dtype in self.columns:
+            values = chunk[name]
+            if dtype == "str":
+                vocab = self.vocab[name]
+                codes = [vocab.setdefault(v, len(vocab)) for v in values]
+                values = np.array(codes, dtype=np.int32)
+            else:
+                values = column_array(values, dtype)
+            values.tofile(self.files[name])
+
+    def close(self, rows):
+        columns = {}
+        for name, dtype in self.columns:
+            self.files[name].close()
+            column = {"file": os.path.basename(self.files[name].name), "dtype": dtype}
+            if dtype == "str":
+                column["dtype"] = "int32"
+                column["vocab"] = "{0}.{1}.vocab.json".format(os.path.basename(self.path), name)
+                words = sorted(self.vocab[name], key=self.vocab[name].get)
+                with open(os.path.join(os.path.dirname(self.path), column["vocab"]), "w") as f:
+                    json.dump(words, f)
+            columns[name] = column
+        return {"format": "memmap", "columns": columns, "rows": rows}
+
+
+class ColumnarBuilder(object):
+    """ collects the rows of every table, flushing CHUNK_ROWS at a time """
+
+    def __init__(self, cache_dir, chunk_rows=CHUNK_ROWS):
+        writer = ParquetTableWriter if pa is not None else MemmapTableWriter
+        self.chunk_rows = chunk_rows
+        self.writers = dict((t, writer(os.path.join(cache_dir, t), TABLES[t])) for t in TABLES)
+        self.chunks = dict((t, self.empty_chunk(t)) for t in TABLES)
+        self.rows = dict((t, 0) for t in TABLES)
+        self.pending = dict((t, 0) for t in TABLES)
+
+    def empty_chunk(self, table):
+        return dict((name, []) for name, _ in TABLES[table])
+
+    def add(self, table, row):
+        chunk = self.chunks[table]
+        for name, _ in TABLES[table]:
+            chunk[name].append(row[name])
+        self.rows[table] += 1
+        self.pending[table] += 1
+        if self.pending[table] >= self.chunk_rows:
+            self.flush(table)
+
+    def flush(self, table):
+        if self.pending[table]:
+            self.writers[table].write(self.chunks[table])
+            self.chunks[table] = self.empty_chunk(table)
+            self.pending[table] = 0
+
+    def element(self, elem):
+        a = elem.attrib
+        element_id = int(a["id"])
+        row = {"id": element_id, "version": int(a.get("version", 0)),
+               "changeset": int(a.get("changeset", 0)),
+               "timestamp": a.get("timestamp", "1970-01-01T00:00:00Z"),
+               "uid": int(a.get("uid", -1)), "user": a.get("user", "")}
+        if elem.tag == "node":
+            row["lat"] = float(a.get("lat", "nan"))
+            row["lon"] = float(a.get("lon", "nan"))
+        self.add(ELEMENT_TABLES[elem.tag], row)
+        for tag in elem.iter("tag"):
+            self.add("tags", {"element": elem.tag, "id": element_id,
+                              "k": tag.attrib["k"], "v": tag.attrib["v"]})
+        for seq, nd in enumerate(elem.iter("nd")):
+            self.add("nds", {"way_id": element_id, "ref": int(nd.attrib["ref"]), "seq": seq})
+        for member in elem.iter("member"):
+            self.add("members", {"relation_id": element_id, "type": member.attrib["type"],
+                                 "ref": int(member.attrib["ref"]),
+                                 "role": member.attrib.get("role", "")})
+
+    def close(self):
+        tables = {}
+        for table in TABLES:
+            self.flush(table)
+            tables[table] = self.writers[table].close(self.rows[table])
+        return tables
+
+
+def file_hash(source, block_size=1024 ** 2):
+    """ sha1 hex digest of a file """
+    sha1 = hashlib.sha1()
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def source_stat(source):
+    st = os.stat(source)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+
+def iter_counted(source, others):
+    """ the top-level node, way, and relation elements of source (as
+        osm_stream.iter_elements), adding the tags of the root and of every
+        other element, children included, to the Counter others
+    """
+    root = None
+    depth = 0
+    for event, elem in iterparse(source):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            others[elem.tag] += 1
+        elif depth == 1:
+            if elem.tag in ELEMENT_TAGS:
+                yield elem
+            else:
+                others.update(child.tag for child in elem.iter())
+            elem.clear()
+            root.remove(elem)
+
+
+def build_cache(source, cache_dir, chunk_rows=CHUNK_ROWS):
+    """ parse source into the tables in cache_dir, returning the manifest """
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+    builder = ColumnarBuilder(cache_dir, chunk_rows)
+    others = Counter()
+    for elem in iter_counted(source, others):
+        builder.element(elem)
+    manifest = source_stat(source)
+    manifest["sha1"] = file_hash(source)
+    manifest["tables"] = builder.close()
+    manifest["others"] = dict(others)
+    with open(os.path.join(cache_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def cache_is_valid(source, cache_dir):
+    """ True if the tables in cache_dir were built from source as it is now """
+    path = os.path.join(cache_dir, MANIFEST)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        manifest = json.load(f)
+    if "others" not in manifest:
+        # built before the other elements were counted
+        return False
+    stat = source_stat(source)
+    if stat == dict((k, manifest.get(k)) for k in stat):
+        return True
+    if stat["size"] != manifest.get("size") or file_hash(source) != manifest.get("sha1"):
+        return False
+    # touched but not changed: remember the new mtime
+    manifest.update(stat)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return True
+
+
+def load_table(cache_dir, info):
+    """ one table of the cache as a DataFrame """
+    if info["format"] == "parquet":
+        return pd.read_parquet(os.path.join(cache_dir, info["file"]))
+    columns = {}
+    for name, column in info["columns"].items():
+        values = np.memmap(os.path.join(cache_dir, column["file"]), dtype=column["dtype"],
+                           mode="r", shape=(info["rows"],)) if info["rows"] else \
+            np.empty(0, dtype=column["dtype"])
+        if "vocab" in column:
+            with open(os.path.join(cache_dir, column["vocab"])) as f:
+                values = pd.Categorical.from_codes(values, json.load(f))
+        columns[name] = values
+    return pd.DataFrame(columns)
+
+
+def columnar_cache(source, cache_dir=None, rebuild=False):
+    """ the tables of source as {name: DataFrame}, parsing the XML only
+        if the cache is missing or out of date
+    """
+    cache_dir = cache_dir or source + ".columns"
+    if rebuild or not cache_is_valid(source, cache_dir):
+        build_cache(source, cache_dir)
+    with open(os.path.join(cache_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    tables = dict((table, load_table(cache_dir, info))
+                  for table, info in manifest["tables"].items())
+    tables["others"] = pd.DataFrame(sorted(manifest["others"].items()),
+                                    columns=["element", "count"])
+    return tables
+
+
+def audit_tables(tables, keys, street_keys=STREET_KEYS, street_type_re=STREET_TYPE_RE):
+    """ the report's audits over the tables, in the same form as the
+        results of an AuditEngine with TagCounter ("tags"), UserCounter
+        ("users"), StreetTypeAuditor ("street_types"), and a TagProfiler
+        of keys ("values")
+    """
+    tags = tables["tags"]
+    counts = {"node": len(tables["nodes"]), "way": len(tables["ways"]),
+              "relation": len(tables["relations"]), "tag": len(tags),
+              "nd": len(tables["nds"]), "member": len(tables["members"])}
+    others = tables["others"]
+    for element, count in zip(others["element"], others["count"]):
+        counts[element] = counts.get(element, 0) + int(count)
+
+    elements = pd.concat([tables[t][["uid", "user"]] for t in ("nodes", "ways", "relations")])
+    uids = elements["uid"][elements["uid"] >= 0].astype(str).value_counts()
+    users = elements["user"].astype(str)
+    users = users[users != ""].value_counts()
+
+    on_ways = tags["element"].isin(["node", "way"])
+    names = tags.loc[on_ways & tags["k"].isin(street_keys), "v"].astype(str).drop_duplicates()
+    types = names.str.extract("(" + street_type_re.pattern + ")", flags=street_type_re.flags)[0]
+    street_types = defaultdict(set)
+    for name, street_type in zip(names[types.notnull()], types[types.notnull()]):
+        street_types[street_type].add(name)
+
+    values = tags.loc[on_ways & tags["k"].isin(keys), ["k", "v"]].astype(str)
+    values = values.groupby(["k", "v"]).size().reset_index(name="count")
+    values = values.sort_values(["k", "count", "v"], ascending=[True, False, True])
+    values = values.rename(columns={"k": "key", "v": "value"}).set_index(["key", "value"])
+
+    return {"tags": counts,
+            "users": {"uid": Counter(uids.to_dict()), "user": Counter(users.to_dict())},
+            "street_types": street_types,
+            "values": values}
+
+
+def map_values(values, mapping):
+    """ replace values found in mapping, keep all others """
+    mapped = values.map(mapping)
+    return values.where(mapped.isnull(), mapped)
+
+
+def truncate_values(values, length):
+    """ keep the first length characters """
+    return values.str.slice(0, length)
+
+
+def first_values(values, delimiters):
+    """ keep the text before the first of any of the delimiters """
+    if not delimiters:
+        return values
+    pattern = "(?s)[" + "".join(re.escape(d) for d in delimiters) + "].*"
+    return values.str.replace(pattern, "", regex=True)
+
+
+def street_values(values, mapping, cache_size=None):
+    """ replace the street type (last word) of names, if in mapping """
+    if not len(values):
+        return values
+    parts = values.str.rpartition(" ")
+    full = parts[2].map(mapping)
+    fixed = parts[0] + parts[1] + full
+    return values.where(full.isnull(), fixed)
+
+
+VECTOR_RULE_TYPES = {"map": map_values, "truncate": truncate_values, "first": first_values,
+                     "street": street_values}
+
+
+def clean_values(values, key, rules=None, **mappings):
+    """ a Series of values of tag key, cleaned by the rule for key """
+    rules = DEFAULT_RULES if rules is None else rules
+    check_mappings(rules, mappings)
+    rule = rules.get(key)
+    if rule is None:
+        return values
+    args = dict((k, v) for k, v in rule.items() if k != "rule")
+    if "mapping" in args:
+        args["mapping"] = mappings.get(args["mapping"]) or {}
+    return VECTOR_RULE_TYPES[rule["rule"]](values.astype(object), **args)
+
+
+def clean_tags(tags, rules=None, **mappings):
+    """ copy of a tags table with every value cleaned by its key's rule """
+    rules = DEFAULT_RULES if rules is None else rules
+    tags = tags.copy()
+    tags["v"] = tags["v"].astype(object)
+    keys = tags["k"].astype(object)
+    for key in rules:
+        mask = (keys == key).values
+        if mask.any():
+            tags.loc[mask, "v"] = clean_values(tags.loc[mask, "v"], key, rules, **mappings)
+    return tags
+
+
+def clean_value_counts(counts, key, rules=None, **mappings):
+    """ counts by value of tag key (a Series indexed by value) summed by
+        cleaned value, largest first
+    """
+    cleaned = clean_values(pd.Series(counts.index, index=counts.index), key, rules, **mappings)
+    summed = counts.groupby(cleaned.values).sum()
+    return summed.sort_values(ascending=False, kind="mergesort")
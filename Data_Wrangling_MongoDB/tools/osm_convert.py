@@ -0,0 +1,376 @@
+#!/usr/bin/python
+
+"""
+    Convert an Open Street Map XML file into JSON documents for MongoDB.
+
+    Elements are shaped into dictionaries by a Cleaner (see osm_clean),
+    which applies the five cleaning steps from the report; the cleaning
+    mappings are passed in as keyword arguments:
+
+    mappings = {"street_types": mapping_street_name,
+                "tiger_types": mapping_tiger_type,
+                "surfaces": mapping_surface}
+    process_map(file_in, **mappings)
+
+    Street names are fixed as they are met, so no audit pass is needed
+    before the conversion. With report set to a file name, the audit of
+    the street names done along the way (see Cleaner.report) is written
+    there as json once the conversion is done:
+
+    process_map(file_in, report=file_in + ".streets.json", **mappings)
+
+    geometry=("coords", "bbox") adds the coordinates and bounding box of
+    every way, from an index of the nodes built in the same pass and kept
+    in the "{file_in}.nodes.*.bin" files (see osm_geometry).
+
+    process_map streams: shaped documents are handed one at a time to a
+    list of sinks and are not kept in memory. The default sink writes
+    the "{file_in}.json" file; other sinks load MongoDB or count
+    documents, and any object with write(el) and close() methods works:
+
+    counts = CounterSink()
+    process_map(file_in, sinks=[JsonLinesSink(file_out), counts], **mappings)
+
+    collect=True also returns the shaped documents as a list, which is
+    only meant for small files such as the case study's example.osm.
+
+    output selects the format of the file written: "json" (one line of
+    json per document, as mongoimport reads it), "fast-json" (the same,
+    written with orjson if it is installed, non-ascii text left as utf-8),
+    or "bson" (what mongorestore reads). compress=True gzips the file;
+    mongorestore reads a .bson.gz file with --gzip. iter_documents reads
+    any of them back:
+
+    process_map(file_in, output="bson", compress=True, **mappings)
+    docs = iter_documents(file_in + ".bson.gz")
+
+    process_map_parallel does the same conversion with a pool of worker
+    processes. The XML is cut into shards of roughly shard_bytes on
+    element boundaries; each worker parses and shapes one shard and the
+    shards are written back in file order, so the output is identical to
+    process_map. With per_shard=True every shard is written to its own
+    numbered file instead of one ordered file.
+"""
+
+import gzip
+import io
+import json
+import multiprocessing
+import re
+from collections import deque
+
+from osm_stream import iter_elements, open_osm
+from osm_clean import Cleaner
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SHARD_BYTES = 4 * 1024 ** 2
+# zlib's default level: most of the size reduction of level 9, much faster
+GZIP_LEVEL = 6
+ELEMENT_STARTS = (b"<node", b"<way", b"<relation")
+ELEMENT_START_RE = re.compile(br"<(?:node|way|relation)[\s/>]")
+
+
+def dumps(el, pretty=False):
+    """ one shaped element as a line of json """
+    if pretty:
+        return json.dumps(el, indent=2) + "\n"
+    return json.dumps(el) + "\n"
+
+
+def encode_json(el, pretty=False):
+    """ one shaped element as a utf-8 line of json """
+    return dumps(el, pretty).encode("utf-8")
+
+
+def encode_fast_json(el, pretty=False):
+    """ encode_json with orjson, if it is installed """
+    if orjson is None:
+        return encode_json(el, pretty)
+    return orjson.dumps(el, option=orjson.OPT_APPEND_NEWLINE |
+                        (orjson.OPT_INDENT_2 if pretty else 0))
+
+
+def encode_bson(el, pretty=False):
+    """ one shaped element as a bson document """
+    # pymongo's bson, only needed for bson output
+    import bson
+    return bson.BSON.encode(el)
+
+
+# output format: (file extension, encoder)
+OUTPUT_FORMATS = {"json": (".json", encode_json),
+                  "fast-json": (".json", encode_fast_json),
+                  "bson": (".bson", encode_bson)}
+
+
+def output_name(file_in, output="json", compress=False):
+    """ name of the file process_map writes for file_in """
+    return file_in + OUTPUT_FORMATS[output][0] + (".gz" if compress else "")
+
+
+def open_output(filename):
+    """ binary file for writing, gzip'd if filename ends in .gz """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wb", GZIP_LEVEL)
+    return open(filename, "wb")
+
+
+def gzip_bytes(data):
+    """ data as one gzip member; members can be concatenated into a file """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=GZIP_LEVEL) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class FileSink(object):
+    """ writes each document to filename in an OUTPUT_FORMATS format,
+        gzip'd if filename ends in .gz
+    """
+
+    def __init__(self, filename, output="json", pretty=False):
+        self.encode = OUTPUT_FORMATS[output][1]
+        self.pretty = pretty
+        self.fo = open_output(filename)
+
+    def write(self, el):
+        self.fo.write(self.encode(el, self.pretty))
+
+    def close(self):
+        self.fo.close()
+
+
+class JsonLinesSink(FileSink):
+    """ writes each document as one line of json """
+
+    def __init__(self, filename, pretty=False):
+        FileSink.__init__(self, filename, "json", pretty)
+
+
+def iter_documents(filename):
+    """ the documents of a file written by a FileSink, json (one line
+        per document, so not pretty) or bson, gzip'd or not
+    """
+    with (gzip.open(filename, "rb") if filename.endswith(".gz") else open(filename, "rb")) as f:
+        if filename.endswith((".bson", ".bson.gz")):
+            import bson
+            for doc in bson.decode_file_iter(f):
+                yield doc
+        else:
+            loads = orjson.loads if orjson is not None else json.loads
+            for line in f:
+                yield loads(line)
+
+
+class MongoSink(object):
+    """ inserts documents into a pymongo collection in unordered batches """
+
+    def __init__(self, collection, batch_size=1000):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.batch = []
+
+    def write(self, el):
+        # insert_many adds an _id to every document it is given, so a
+        # copy is inserted and the other sinks still see the original
+        self.batch.append(dict(el))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.collection.insert_many(self.batch, ordered=False)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+
+
+class CounterSink(object):
+    """ number of documents of each type (node, way, ...) """
+
+    def __init__(self):
+        self.counts = {}
+
+    def write(self, el):
+        self.counts[el["type"]] = self.counts.get(el["type"], 0) + 1
+
+    def close(self):
+        pass
+
+
+def iter_shaped(file_in, shape=None, **mappings):
+    """ yield the shaped document of every node and way in file_in
+
+        shape is a function of one element; by default it is the shape
+        method of a Cleaner built from mappings
+    """
+    if shape is None:
+        shape = Cleaner(**mappings).shape
+    for element in iter_elements(file_in):
+        el = shape(element)
+        if el:
+            yield el
+
+
+# Output to JSON format
+# function that converts xml to json/mangoDB
+# source: modified code from udacity case study
+def process_map(file_in, pretty=False, sinks=None, collect=False,
+                shape=None, report=None, output="json", compress=False, geometry=None,
+                **mappings):
+    if sinks is None:
+        sinks = [FileSink(output_name(file_in, output, compress), output, pretty)]
+    cleaner = None
+    if shape is None:
+        cleaner = Cleaner(**mappings)
+        shape = cleaner.shape
+    ways = None
+    if geometry:
+        # needs numpy, which plain conversions do without
+        from osm_geometry import WayGeometry
+        ways = WayGeometry(file_in + ".nodes", shape, geometry)
+        shape = ways.shape
+    data = []
+    try:
+        for el in iter_shaped(file_in, shape, **mappings):
+            for sink in sinks:
+                sink.write(el)
+            if collect:
+                data.append(el)
+    finally:
+        for sink in sinks:
+            sink.close()
+        if ways is not None:
+            ways.close()
+    if report and cleaner is not None:
+        with open(report, "w") as f:
+            json.dump(cleaner.report(), f, indent=2, sort_keys=True)
+    if collect:
+        return data
+    return True
+
+
+def _last_element_start(buf):
+    """ offset of the last node/way/relation start tag in buf, or -1 """
+    last = -1
+    for start in ELEMENT_STARTS:
+        i = buf.rfind(start)
+        while i > last and not ELEMENT_START_RE.match(buf, i):
+            i = buf.rfind(start, 0, i)
+        last = max(last, i)
+    return last
+
+
+def iter_shards(source, shard_bytes=SHARD_BYTES):
+    """ yield the raw bytes of consecutive runs of top-level elements
+
+        every shard starts at a node/way/relation start tag and ends just
+        before the next one, so each can be parsed on its own once it is
+        wrapped in <osm></osm>; the header and closing tag are dropped
+    """
+    f = source if hasattr(source, "read") else open_osm(source)
+    try:
+        buf = b""
+        started = False
+        while True:
+            block = f.read(shard_bytes)
+            if not block:
+                break
+            buf += block
+            if not started:
+                m = ELEMENT_START_RE.search(buf)
+                if not m:
+                    continue
+                buf = buf[m.start():]
+                started = True
+            cut = _last_element_start(buf)
+            if cut > 0:
+                yield buf[:cut]
+                buf = buf[cut:]
+        if started:
+            end = buf.rfind(b"</osm>")
+            if end >= 0:
+                buf = buf[:end]
+            if buf.strip():
+                yield buf
+    finally:
+        if f is not source:
+            f.close()
+
+
+_worker_options = {}
+
+
+def _init_worker(pretty, mappings, output="json", compress=False):
+    _worker_options["pretty"] = pretty
+    _worker_options["shape"] = Cleaner(**mappings).shape
+    _worker_options["encode"] = OUTPUT_FORMATS[output][1]
+    _worker_options["compress"] = compress
+
+
+def _shape_shard(shard):
+    """ encoded documents for every node and way in one shard """
+    pretty = _worker_options["pretty"]
+    shape = _worker_options["shape"]
+    encode = _worker_options["encode"]
+    docs = []
+    for element in iter_elements(io.BytesIO(b"<osm>" + shard + b"</osm>")):
+        el = shape(element)
+        if el:
+            docs.append(encode(el, pretty))
+    data = b"".join(docs)
+    if _worker_options["compress"]:
+        # compressed by the worker, as a gzip member of its own
+        data = gzip_bytes(data)
+    return data
+
+
+def process_map_parallel(file_in, pretty=False, processes=None,
+                         shard_bytes=SHARD_BYTES, per_shard=False, output="json",
+                         compress=False, **mappings):
+    """ process_map on a pool of worker processes
+
+        at most two shards per worker are in flight at a time, so memory
+        stays bounded no matter how large file_in is; returns the list
+        of files written
+    """
+    processes = processes or multiprocessing.cpu_count()
+    file_out = output_name(file_in, output, compress)
+    files = []
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (pretty, mappings, output, compress))
+    fo = None
+    try:
+        if not per_shard:
+            fo = open(file_out, "wb")
+            files.append(file_out)
+        pending = deque()
+
+        def write_next():
+            data = pending.popleft().get()
+            if per_shard:
+                name = "{0}.{1:05d}".format(file_out, len(files))
+                with open(name, "wb") as shard_out:
+                    shard_out.write(data)
+                files.append(name)
+            else:
+                fo.write(data)
+
+        for shard in iter_shards(file_in, shard_bytes):
+            pending.append(pool.apply_async(_shape_shard, (shard,)))
+            if len(pending) >= 2 * processes:
+                write_next()
+        while pending:
+            write_next()
+    finally:
+        pool.close()
+        pool.join()
+        if fo is not None:
+            fo.close()
+    return files
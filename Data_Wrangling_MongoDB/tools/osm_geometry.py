@@ -0,0 +1,351 @@
+#!/usr/bin/python
+
+"""
+    Way and relation geometry from on-disk indexes of node coordinates
+    and way extents.
+
+    Shaped ways only have the ids of their nodes (node_refs), so using a
+    road spatially would need a lookup per node. A NodeIndex keeps the
+    id, lat, and lon of every node as three flat binary files: ids sorted
+    as int64, coordinates as float64 in the same order. They are opened
+    as NumPy memory maps and a whole way is resolved with one
+    np.searchsorted call, so tens of millions of nodes need no Python
+    object per node and only the pages touched are read into memory.
+
+    index = build_node_index(file_in, file_in + ".nodes")
+    lat, lon = index.lookup([61436121, 61436123])
+
+    An ExtentIndex is the same for the bounding box (lat min, lon min,
+    lat max, lon max) of every way.
+
+    Both can be built during the conversion itself: Open Street Map files
+    list every node, then every way, then every relation. WayGeometry
+    adds each node to the node index as it is shaped, finishes the index
+    when the first way arrives, and from then on adds the coordinates
+    ("coords", [[lat, lon], ...] in node order) and/or bounding box
+    ("bbox", [[lat min, lon min], [lat max, lon max]]) to every way
+    document. With "members" in geometry it also keeps the extent of
+    every way on disk, and once the relations begin adds a "bbox" to each
+    of their node and way members and to the relation itself:
+
+    process_map(file_in, geometry=("bbox",), **mappings)
+    load_map(file_in, db.southbendin, geometry=("coords", "bbox", "members"),
+             relations=True, **mappings)
+
+    Change files (see osm_mongo.apply_changes) list only the elements
+    that changed, so a modified way's nodes are mostly not in them.
+    ChangeGeometry resolves them against the indexes written when the map
+    was loaded, with the nodes and ways changed earlier in the same file
+    taking precedence:
+
+    apply_changes(changes_file, db.southbendin, nodes=file_in + ".nodes",
+                  geometry=("coords", "bbox", "members"), **mappings)
+
+    Nodes and ways missing from the extract (clipped at its edge) are
+    left out; a way or member with none of its nodes in the extract gets
+    no geometry. Members that are relations get no bbox either.
+"""
+
+import os
+
+import numpy as np
+
+
+CHUNK_ROWS = 1000000
+NODE_COLUMNS = (("ids", np.int64), ("lat", np.float64), ("lon", np.float64))
+EXTENT_COLUMNS = (("ids", np.int64), ("lat_min", np.float64), ("lon_min", np.float64),
+                  ("lat_max", np.float64), ("lon_max", np.float64))
+GEOMETRY = ("coords", "bbox")
+
+
+def open_columns(path, columns):
+    """ the memory maps of the index columns at path """
+    arrays = {}
+    for name, dtype in columns:
+        filename = "{0}.{1}.bin".format(path, name)
+        if os.path.getsize(filename):
+            arrays[name] = np.memmap(filename, dtype=dtype, mode="r")
+        else:
+            arrays[name] = np.zeros(0, dtype=dtype)
+    return arrays
+
+
+def is_sorted(ids, chunk_rows=CHUNK_ROWS):
+    """ whether ids never decrease, read chunk_rows at a time """
+    for i in range(0, len(ids), chunk_rows):
+        # each chunk overlaps the next by one id
+        chunk = ids[i:i + chunk_rows + 1]
+        if (chunk[1:] < chunk[:-1]).any():
+            return False
+    return True
+
+
+def sort_index(path, columns, chunk_rows=CHUNK_ROWS):
+    """ sort the index files by id, unless they already are (extracts
+        list elements by id, so usually they are)
+    """
+    arrays = open_columns(path, columns)
+    ids = arrays["ids"]
+    if is_sorted(ids, chunk_rows):
+        return
+    order = np.argsort(ids, kind="mergesort")
+    for name, dtype in columns:
+        filename = "{0}.{1}.bin".format(path, name)
+        with open(filename + ".tmp", "wb") as f:
+            for i in range(0, len(order), chunk_rows):
+                arrays[name][order[i:i + chunk_rows]].tofile(f)
+    del arrays, ids
+    for name, _ in columns:
+        filename = "{0}.{1}.bin".format(path, name)
+        os.rename(filename + ".tmp", filename)
+
+
+class SortedIndex(object):
+    """ rows of the index files at path, found by id """
+
+    columns = NODE_COLUMNS
+
+    def __init__(self, path):
+        self.arrays = open_columns(path, self.columns)
+        self.ids = self.arrays["ids"]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, refs):
+        """ (positions in the index, mask of refs found) for refs """
+        refs = np.asarray(refs, dtype=np.int64)
+        if not len(self.ids):
+            return refs[:0], np.zeros(len(refs), dtype=bool)
+        i = np.searchsorted(self.ids, refs)
+        i[i == len(self.ids)] = 0
+        found = self.ids[i] == refs
+        return i[found], found
+
+    def rows(self, refs):
+        """ (n, columns - 1) array of the rows of the refs that are in the
+            index, in the order of refs, and the mask of those found
+        """
+        i, found = self.find(refs)
+        return np.column_stack([self.arrays[name][i] for name, _ in self.columns[1:]]), found
+
+
+class NodeIndex(SortedIndex):
+    """ coordinates of nodes by id """
+
+    columns = NODE_COLUMNS
+
+    def lookup(self, refs):
+        """ lat and lon arrays of the nodes in refs that are in the index,
+            in the order of refs
+        """
+        i, _ = self.find(refs)
+        return np.asarray(self.arrays["lat"][i]), np.asarray(self.arrays["lon"][i])
+
+
+class ExtentIndex(SortedIndex):
+    """ bounding boxes of ways by id (rows are lat min, lon min, lat max,
+        lon max)
+    """
+
+    columns = EXTENT_COLUMNS
+
+
+class IndexWriter(object):
+    """ appends rows to the index files at path """
+
+    index = NodeIndex
+
+    def __init__(self, path, chunk_rows=CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.chunk = [[] for _ in self.index.columns]
+        self.files = [open("{0}.{1}.bin".format(path, name), "wb")
+                      for name, _ in self.index.columns]
+
+    def add(self, *row):
+        for column, value in zip(self.chunk, row):
+            column.append(value)
+        if len(self.chunk[0]) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        for column, f, (_, dtype) in zip(self.chunk, self.files, self.index.columns):
+            np.array(column, dtype=dtype).tofile(f)
+            del column[:]
+
+    def close(self):
+        """ the finished index, sorted by id """
+        if self.files is not None:
+            self.flush()
+            for f in self.files:
+                f.close()
+            self.files = None
+            sort_index(self.path, self.index.columns, self.chunk_rows)
+        return self.index(self.path)
+
+
+class NodeIndexWriter(IndexWriter):
+    """ add(id, lat, lon) for every node """
+
+    index = NodeIndex
+
+
+class ExtentIndexWriter(IndexWriter):
+    """ add(id, lat min, lon min, lat max, lon max) for every way """
+
+    index = ExtentIndex
+
+
+def build_node_index(file_in, path, chunk_rows=CHUNK_ROWS):
+    """ NodeIndex of every node in file_in, written to path """
+    from osm_stream import iter_elements
+    writer = NodeIndexWriter(path, chunk_rows)
+    for element in iter_elements(file_in, ("node",)):
+        a = element.attrib
+        if "lat" in a and "lon" in a:
+            writer.add(int(a["id"]), float(a["lat"]), float(a["lon"]))
+    return writer.close()
+
+
+def bbox(lat_min, lon_min, lat_max, lon_max):
+    """ [[lat min, lon min], [lat max, lon max]] as plain floats """
+    return [[float(lat_min), float(lon_min)], [float(lat_max), float(lon_max)]]
+
+
+def add_geometry(doc, lat, lon, geometry=GEOMETRY):
+    """ add the coords and/or bbox of a way's resolved nodes to doc """
+    if not len(lat):
+        return doc
+    if "coords" in geometry:
+        doc["coords"] = np.column_stack((lat, lon)).tolist()
+    if "bbox" in geometry:
+        doc["bbox"] = bbox(lat.min(), lon.min(), lat.max(), lon.max())
+    return doc
+
+
+def add_member_geometry(doc, node_index, way_index):
+    """ add the bbox of each node and way member of a relation, and of
+        the whole relation, to doc
+    """
+    extents = []
+    for kind, index in (("node", node_index), ("way", way_index)):
+        members = [m for m in doc["members"] if m.get("type") == kind]
+        if not members:
+            continue
+        rows, found = index.rows([m["ref"] for m in members])
+        if kind == "node":
+            # a node's extent is its position
+            rows = np.column_stack((rows, rows))
+        for member, row in zip([m for m, f in zip(members, found) if f], rows):
+            member["bbox"] = bbox(*row)
+        extents.append(rows)
+    if extents:
+        rows = np.concatenate(extents)
+        if len(rows):
+            doc["bbox"] = bbox(rows[:, 0].min(), rows[:, 1].min(),
+                               rows[:, 2].max(), rows[:, 3].max())
+    return doc
+
+
+class ChangedIndex(object):
+    """ rows of a SortedIndex (or none) by id, with the rows of changed
+        ids (kept in memory) taking precedence
+    """
+
+    def __init__(self, index, width):
+        self.index = index
+        self.width = width
+        self.changed = {}
+
+    def rows(self, refs):
+        """ like SortedIndex.rows """
+        refs = np.asarray(refs, dtype=np.int64)
+        rows = np.zeros((len(refs), self.width), dtype=np.float64)
+        found = np.zeros(len(refs), dtype=bool)
+        if self.index is not None:
+            indexed, found = self.index.rows(refs)
+            rows[found] = indexed
+        if self.changed:
+            for k, ref in enumerate(refs.tolist()):
+                row = self.changed.get(ref)
+                if row is not None:
+                    rows[k] = row
+                    found[k] = True
+        return rows[found], found
+
+
+class ChangeGeometry(object):
+    """ wraps a shape function for change files: adds geometry to ways
+        (and relations) from the finished indexes at path, written by
+        WayGeometry when the map was loaded
+    """
+
+    def __init__(self, path, shape, geometry=GEOMETRY):
+        self.inner = shape
+        self.geometry = geometry
+        self.nodes = ChangedIndex(NodeIndex(path), 2)
+        ways = None
+        if "members" in geometry and os.path.exists(path + ".ways.ids.bin"):
+            ways = ExtentIndex(path + ".ways")
+        self.ways = ChangedIndex(ways, 4)
+
+    def shape(self, element):
+        doc = self.inner(element)
+        if not doc:
+            return doc
+        if element.tag == "node" and "pos" in doc:
+            self.nodes.changed[int(doc["id"])] = doc["pos"]
+        elif element.tag == "way" and "node_refs" in doc:
+            rows, _ = self.nodes.rows(doc["node_refs"])
+            add_geometry(doc, rows[:, 0], rows[:, 1], self.geometry)
+            if len(rows):
+                self.ways.changed[int(doc["id"])] = (rows[:, 0].min(), rows[:, 1].min(),
+                                                     rows[:, 0].max(), rows[:, 1].max())
+        elif element.tag == "relation" and "members" in doc and "members" in self.geometry:
+            add_member_geometry(doc, self.nodes, self.ways)
+        return doc
+
+
+class WayGeometry(object):
+    """ wraps a shape function: indexes nodes (and way extents) as they
+        are shaped and adds geometry to the ways (and relations) that
+        follow them; path is the prefix of the index files
+    """
+
+    def __init__(self, path, shape, geometry=GEOMETRY, chunk_rows=CHUNK_ROWS):
+        self.inner = shape
+        self.geometry = geometry
+        self.nodes = NodeIndexWriter(path, chunk_rows)
+        self.node_index = None
+        self.ways = None
+        self.way_index = None
+        if "members" in geometry:
+            self.ways = ExtentIndexWriter(path + ".ways", chunk_rows)
+
+    def shape(self, element):
+        doc = self.inner(element)
+        if element.tag == "node":
+            if self.node_index is None and doc and "pos" in doc:
+                self.nodes.add(int(doc["id"]), doc["pos"][0], doc["pos"][1])
+        elif element.tag == "way":
+            if self.node_index is None:
+                self.node_index = self.nodes.close()
+            if doc and "node_refs" in doc:
+                lat, lon = self.node_index.lookup(doc["node_refs"])
+                add_geometry(doc, lat, lon, self.geometry)
+                if self.ways is not None and self.way_index is None and len(lat):
+                    self.ways.add(int(doc["id"]), lat.min(), lon.min(), lat.max(), lon.max())
+        elif element.tag == "relation":
+            self.close()
+            if doc and "members" in doc and self.way_index is not None:
+                add_member_geometry(doc, self.node_index, self.way_index)
+        return doc
+
+    def close(self):
+        """ finish the indexes that are still being written """
+        if self.node_index is None:
+            self.node_index = self.nodes.close()
+        if self.ways is not None and self.way_index is None:
+            self.way_index = self.ways.close()
+        return self.node_index
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+"""
+    Indexes for the southbendin collection and a query planner report.
+
+    Without indexes every query in the report's MongoDB section is a full
+    collection scan. INDEXES declares the indexes those queries need;
+    create_indexes builds them once the data is loaded, and explain_query
+    runs explain() on one command to show which plan the server picks.
+    osm_runner.explain_report explains every command the report sends:
+
+    create_indexes(db.southbendin)
+    print_explain_report(explain_report(db.southbendin))
+
+    Each row of the report has the winning plan's stages (COLLSCAN is a
+    full scan, IXSCAN / COUNT_SCAN / DISTINCT_SCAN use an index), the
+    index keys and documents examined, the documents returned, and the
+    execution time in milliseconds.
+"""
+
+from bson.son import SON
+from pymongo import IndexModel, ASCENDING, GEO2D, TEXT
+
+
+# documents are unique by type and id, and found by them when change
+# files are applied (see osm_mongo)
+ID_INDEX = IndexModel([("id", ASCENDING), ("type", ASCENDING)], name="id_type", unique=True)
+
+INDEXES = [
+    IndexModel([("type", ASCENDING)], name="type"),
+    ID_INDEX,
+    IndexModel([("amenity", ASCENDING)], name="amenity"),
+    IndexModel([("created.user", ASCENDING)], name="created_user"),
+    IndexModel([("tiger.zip_left", ASCENDING)], name="tiger_zip_left"),
+    IndexModel([("bicycle", ASCENDING)], name="bicycle"),
+    IndexModel([("name", ASCENDING)], name="name"),
+    # osm_search finds names and streets by value with $in
+    IndexModel([("address.street", ASCENDING)], name="address_street"),
+    # pos is [lat, lon]; a 2d index is indifferent to the order, unlike
+    # 2dsphere which expects [lon, lat]
+    IndexModel([("pos", GEO2D)], name="pos_2d"),
+    IndexModel([("name", TEXT)], name="name_text"),
+]
+
+
+def without_unique(index):
+    """ copy of an IndexModel without its unique constraint """
+    document = dict(index.document)
+    keys = document.pop("key")
+    document.pop("unique", None)
+    return IndexModel(list(keys.items()), **document)
+
+
+def create_indexes(collection, indexes=INDEXES):
+    """ build the indexes (a no-op for those that already exist); a
+        mongomock collection gets them without unique constraints, which
+        it checks against every document on each insert
+    """
+    if type(collection).__module__.startswith("mongomock"):
+        indexes = [without_unique(index) for index in indexes]
+    return collection.create_indexes(indexes)
+
+
+def find_values(doc, key):
+    """ every value stored under key anywhere in a nested explain output """
+    if isinstance(doc, dict):
+        for k, v in doc.items():
+            if k == key:
+                yield v
+            else:
+                for found in find_values(v, key):
+                    yield found
+    elif isinstance(doc, list):
+        for item in doc:
+            for found in find_values(item, key):
+                yield found
+
+
+def plan_stages(plan):
+    """ stage names of a winning plan, outermost first """
+    stages = []
+    while plan:
+        stages.append(plan.get("stage", "?"))
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages
+
+
+def explain_query(collection, command, arguments):
+    """ summary of the executionStats explain output for one command """
+    # the explain command needs the command name as its first field
+    cmd = SON([(command, collection.name)] + sorted(arguments.items()))
+    explained = collection.database.command("explain", cmd, verbosity="executionStats")
+
+    stages = []
+    for plan in find_values(explained, "winningPlan"):
+        stages.extend(plan_stages(plan.get("queryPlan", plan)))
+    row = {"stages": "/".join(stages), "keys_examined": 0,
+           "docs_examined": 0, "returned": 0, "millis": 0}
+    for stats in find_values(explained, "executionStats"):
+        row["keys_examined"] += stats.get("totalKeysExamined", 0)
+        row["docs_examined"] += stats.get("totalDocsExamined", 0)
+        row["returned"] += stats.get("nReturned", 0)
+        row["millis"] += stats.get("executionTimeMillis", 0)
+    return row
+
+
+def print_explain_report(rows):
+    print("{0:<20} {1:<28} {2:>10} {3:>10} {4:>9} {5:>7}".format(
+        "query", "plan", "keys", "docs", "returned", "ms"))
+    for row in rows:
+        print("{query:<20} {stages:<28} {keys_examined:>10} {docs_examined:>10} "
+              "{returned:>9} {millis:>7}".format(**row))
@@ -0,0 +1,357 @@
+#!/usr/bin/python
+
+"""
+    Load an Open Street Map XML file straight into MongoDB.
+
+    load_map streams the shaped documents (see osm_convert) into a
+    pymongo collection with unordered insert_many calls, without writing
+    the intermediate json file that mongoimport needs:
+
+    client = MongoClient('localhost:27017')
+    stats = load_map(file_in, client.openstreetmap.southbendin,
+                     batch_size=1000, checkpoint=file_in + ".checkpoint",
+                     **mappings)
+
+    batch_size is the number of documents per insert_many call.
+
+    max_pending turns on back-pressure: batches are inserted by a writer
+    thread while the file is parsed, and parsing waits whenever
+    max_pending batches are queued, so a slow server never lets the
+    queue grow without bound.
+
+    checkpoint is a file recording how many documents of the file have
+    been written and how many of them were inserted. It is updated after
+    every batch, so a load that is interrupted can be run again with the
+    same arguments and resumes where it stopped. The file is removed once
+    the load completes. A batch that failed part way through (or whose
+    checkpoint was never written) is written again in full, less the
+    documents that already made it: documents are unique by type and id
+    (ID_INDEX), and the first batch of a load with a checkpoint is
+    checked against the collection.
+
+    The returned stats have the number of documents inserted (leaving
+    out duplicates), the time taken, and the documents per second.
+
+    Every load bumps the collection's version number, kept in the
+    META_COLLECTION of the same database, so that anything cached from
+    the collection (see osm_report) knows when it is out of date. The
+    number starts again from 0 when the database is dropped or moved, so
+    caches key on collection_token instead, a random value set by every
+    bump that never repeats.
+
+    apply_changes brings a loaded collection up to date with an OSM change
+    file (.osc) instead of reloading the whole map. Created and modified
+    nodes and ways are shaped by the same Cleaner as load_map and replace
+    the document with the same type and id (inserting it if there is
+    none); deleted ones are removed. The writes go to the server as
+    ordered bulk_write calls of batch_size operations, so an element
+    changed more than once in a file ends up in its last state:
+
+    stats = apply_changes("south-bend.osc", db.southbendin, **mappings)
+
+    Maps loaded with geometry keep it up to date when their changes are
+    applied with the same geometry and nodes, the prefix of the node
+    index files load_map wrote (file_in + ".nodes", see osm_geometry):
+
+    apply_changes(changes_file, db.southbendin, geometry=("coords", "bbox"),
+                  nodes=file_in + ".nodes", **mappings)
+
+    With rollups=True both also keep the counts of the report's rankings
+    (top users, zip codes, ...) up to date as they write (see osm_rollups).
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from osm_convert import iter_shaped
+from osm_clean import Cleaner
+from osm_geometry import ChangeGeometry, WayGeometry
+from osm_indexes import ID_INDEX, create_indexes
+from osm_stream import iter_changes
+from osm_rollups import RollupCounter, merge_rollups, ROLLUPS
+
+
+META_COLLECTION = "osm_meta"
+DUPLICATE_KEY = 11000
+
+
+def collection_version(collection):
+    """ number of times collection has been changed by these tools """
+    meta = collection.database[META_COLLECTION].find_one({"_id": collection.name})
+    return meta["version"] if meta else 0
+
+
+def collection_token(collection):
+    """ value that changes with every bump_version and is never reused,
+        even by a new database of the same name; None if never bumped
+    """
+    meta = collection.database[META_COLLECTION].find_one({"_id": collection.name})
+    return meta.get("token") if meta else None
+
+
+def bump_version(collection):
+    """ record that the documents of collection have changed """
+    collection.database[META_COLLECTION].update_one(
+        {"_id": collection.name},
+        {"$inc": {"version": 1}, "$set": {"token": uuid.uuid4().hex}}, upsert=True)
+
+
+def file_signature(file_in):
+    """ size and modification time, to tell a checkpoint's file apart """
+    st = os.stat(file_in)
+    return {"file": os.path.abspath(file_in), "size": st.st_size, "mtime": st.st_mtime}
+
+
+def read_checkpoint(checkpoint, file_in):
+    """ number of documents of file_in already written, and inserted """
+    if not checkpoint or not os.path.exists(checkpoint):
+        return 0, 0
+    with open(checkpoint) as f:
+        saved = json.load(f)
+    if dict((k, saved.get(k)) for k in ("file", "size", "mtime")) != file_signature(file_in):
+        raise ValueError("checkpoint {0} is for a different file".format(checkpoint))
+    return saved["written"], saved["inserted"]
+
+
+def write_checkpoint(checkpoint, file_in, written, inserted):
+    """ record documents written and inserted, replacing the checkpoint
+        atomically
+    """
+    saved = file_signature(file_in)
+    saved["written"] = written
+    saved["inserted"] = inserted
+    temp = checkpoint + ".tmp"
+    with open(temp, "w") as f:
+        json.dump(saved, f)
+    os.rename(temp, checkpoint)
+
+
+def iter_batches(docs, batch_size):
+    """ lists of up to batch_size documents """
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BatchWriter(object):
+    """ inserts batches on a background thread, at most max_pending queued """
+
+    def __init__(self, insert, max_pending):
+        self.insert = insert
+        self.batches = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if self.error is None:
+                try:
+                    self.insert(batch)
+                except Exception as e:
+                    self.error = e
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.batches.put(batch)
+
+    def close(self):
+        self.batches.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def existing(collection, batch):
+    """ the (type, id) pairs of batch already in collection """
+    found = set()
+    for kind in set(doc["type"] for doc in batch):
+        ids = [doc["id"] for doc in batch if doc["type"] == kind]
+        for doc in collection.find({"type": kind, "id": {"$in": ids}}, {"_id": 0, "id": 1}):
+            found.add((kind, doc["id"]))
+    return found
+
+
+def insert_new(collection, batch):
+    """ insert_many, skipping documents already in collection (by
+        ID_INDEX); returns the documents inserted
+    """
+    if not batch:
+        return batch
+    try:
+        collection.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+        duplicates = set(error["index"] for error in errors)
+        return [doc for i, doc in enumerate(batch) if i not in duplicates]
+    return batch
+
+
+def load_map(file_in, collection, batch_size=1000, checkpoint=None,
+             max_pending=None, geometry=None, rollups=False, **mappings):
+    """ insert every shaped node and way of file_in into collection; with
+        geometry, ways get coordinates and/or bounding boxes (see
+        osm_geometry), and with rollups the inserted documents are added
+        to the collection's rollups
+    """
+    skip, skip_inserted = read_checkpoint(checkpoint, file_in)
+    # documents written and inserted, and whether the first batch has yet
+    # to be checked against the collection (a load with a checkpoint may
+    # be resuming one that died before its first checkpoint, too)
+    loaded = [skip, skip_inserted, bool(checkpoint)]
+    counter = RollupCounter() if rollups else None
+
+    def insert(batch):
+        written = len(batch)
+        if loaded[2]:
+            # that batch may have been written in part before
+            found = existing(collection, batch)
+            batch = [doc for doc in batch if (doc["type"], doc["id"]) not in found]
+            loaded[2] = False
+        inserted = insert_new(collection, batch)
+        loaded[0] += written
+        loaded[1] += len(inserted)
+        if counter is not None:
+            # counted once inserted, so an interrupted load merges the
+            # counts of the batches that made it and the rest on resume
+            for doc in inserted:
+                counter.add(doc)
+        if checkpoint:
+            write_checkpoint(checkpoint, file_in, loaded[0], loaded[1])
+
+    # node and way ids overlap, so documents are unique by type and id
+    create_indexes(collection, [ID_INDEX])
+    ways = None
+    shape = None
+    if geometry:
+        ways = WayGeometry(file_in + ".nodes", Cleaner(**mappings).shape, geometry)
+        shape = ways.shape
+    docs = iter_shaped(file_in, shape, **mappings)
+    for _ in range(skip):
+        next(docs)
+
+    start = time.time()
+    writer = BatchWriter(insert, max_pending) if max_pending else None
+    try:
+        for batch in iter_batches(docs, batch_size):
+            if writer is not None:
+                writer.put(batch)
+            else:
+                insert(batch)
+    finally:
+        try:
+            if writer is not None:
+                writer.close()
+        finally:
+            bump_version(collection)
+            if counter is not None:
+                merge_rollups(collection, counter)
+            if ways is not None:
+                ways.close()
+    elapsed = time.time() - start
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    documents = loaded[1] - skip_inserted
+    return {"documents": documents, "skipped": skip, "seconds": elapsed,
+            "docs_per_sec": documents / elapsed if elapsed > 0 else 0.0}
+
+
+def change_documents(file_in, geometry=None, nodes=None, **mappings):
+    """ (action, type, id, shaped document) for every change in file_in;
+        the document is None for deletes; with geometry, ways and
+        relations get it from the node index at nodes
+    """
+    shape = Cleaner(**mappings).shape
+    if geometry:
+        if nodes is None:
+            raise ValueError("geometry needs the node index the map was loaded with (nodes)")
+        shape = ChangeGeometry(nodes, shape, geometry).shape
+    for action, element in iter_changes(file_in):
+        if action == "delete":
+            yield action, element.tag, element.attrib["id"], None
+        else:
+            # relations are only shaped if the Cleaner is asked to
+            doc = shape(element)
+            if doc:
+                yield action, doc["type"], doc["id"], doc
+
+
+def change_operation(kind, id, doc):
+    """ bulk_write operation that deletes (doc None) or replaces a document """
+    if doc is None:
+        return DeleteOne({"id": id, "type": kind})
+    return ReplaceOne({"id": id, "type": kind}, doc, upsert=True)
+
+
+def count_changes(collection, batch, counter):
+    """ add the rollup counts changed by a batch of change_documents to
+        counter: the documents as they are before the batch are taken out
+        and the last version of each changed one put in
+    """
+    last = {}
+    for _, kind, id, doc in batch:
+        last[(kind, id)] = doc
+    fields = dict((field, 1) for field, _ in ROLLUPS.values())
+    for kind in set(k for k, _ in last):
+        ids = [i for k, i in last if k == kind]
+        for doc in collection.find({"type": kind, "id": {"$in": ids}}, fields):
+            counter.remove(doc)
+    for doc in last.values():
+        if doc is not None:
+            counter.add(doc)
+
+
+def apply_changes(file_in, collection, batch_size=1000, rollups=False, geometry=None,
+                  nodes=None, **mappings):
+    """ apply the creates, modifies, and deletes of an .osc file """
+    create_indexes(collection, [ID_INDEX])
+    counts = {"create": 0, "modify": 0, "delete": 0}
+    counter = RollupCounter() if rollups else None
+    start = time.time()
+    try:
+        changes = change_documents(file_in, geometry, nodes, **mappings)
+        for batch in iter_batches(changes, batch_size):
+            changed = None
+            if counter is not None:
+                # read before the batch is written, counted once it is
+                changed = RollupCounter()
+                count_changes(collection, batch, changed)
+            collection.bulk_write([change_operation(kind, id, doc)
+                                   for _, kind, id, doc in batch], ordered=True)
+            if changed is not None:
+                counter.update(changed)
+            for action, _, _, _ in batch:
+                counts[action] += 1
+    finally:
+        bump_version(collection)
+        if counter is not None:
+            merge_rollups(collection, counter)
+    elapsed = time.time() - start
+    changes = sum(counts.values())
+    return {"created": counts["create"], "modified": counts["modify"],
+            "deleted": counts["delete"], "seconds": elapsed,
+            "changes_per_sec": changes / elapsed if elapsed > 0 else 0.0}
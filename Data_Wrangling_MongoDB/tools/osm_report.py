@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+"""
+    Summary statistics of the southbendin collection for the report.
+
+    The report used to count documents, nodes, ways, schools, and
+    hospitals with one find().count() each, every one of them a scan of
+    the collection. summary_counts gets them all at once: the total from
+    the collection metadata (estimated_document_count) and the rest from
+    a single $facet aggregation, which reads the collection once.
+
+    counts = summary_counts(db.southbendin)
+    counts["nodes"], counts["ways"], counts["schools"]
+
+    Results are cached in memory under the collection's version token
+    (see osm_mongo.collection_token), so repeated refreshes do not touch
+    the collection at all until the tools load or change documents. Data
+    written by other means (mongoimport, the mongo shell) does not bump
+    the version; call bump_version or pass refresh=True after doing so.
+"""
+
+from osm_mongo import collection_token
+
+
+SUMMARY_FACETS = {
+    "nodes": [{"$match": {"type": "node"}}, {"$count": "count"}],
+    "ways": [{"$match": {"type": "way"}}, {"$count": "count"}],
+    "schools": [{"$match": {"amenity": "school"}}, {"$count": "count"}],
+    "hospitals": [{"$match": {"amenity": "hospital"}}, {"$count": "count"}],
+    "users": [{"$match": {"created.user": {"$exists": 1}}},
+              {"$group": {"_id": "$created.user"}}, {"$count": "count"}],
+}
+
+_cache = {}
+
+
+def cached(collection, name, compute, refresh=False):
+    """ compute(collection), cached until the collection version changes """
+    key = (collection.database.name, collection.name, name)
+    version = collection_token(collection)
+    hit = _cache.get(key)
+    if refresh or hit is None or hit[0] != version:
+        hit = _cache[key] = (version, compute(collection))
+    return hit[1]
+
+
+def count_summary(collection):
+    """ documents, nodes, ways, schools, hospitals, and unique users """
+    counts = {"documents": collection.estimated_document_count()}
+    facets = next(collection.aggregate([{"$facet": SUMMARY_FACETS}]))
+    for name, result in facets.items():
+        counts[name] = result[0]["count"] if result else 0
+    return counts
+
+
+def summary_counts(collection, refresh=False):
+    """ count_summary of collection, cached by collection version """
+    return dict(cached(collection, "summary_counts", count_summary, refresh))
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+
+"""
+    Pre-aggregated counts (rollups) of the fields the report ranks.
+
+    The report's top users, top zip codes, bicycle lanes, and top
+    amenities were $group / $sort / $limit aggregations, each a scan of
+    the whole collection every time it ran. The rollups keep the count of
+    every value of those fields (ROLLUPS) in a small collection next to
+    the data ("southbendin_rollups"), one document per value:
+
+    {"_id": {"rollup": "amenities", "value": "school"},
+     "rollup": "amenities", "value": "school", "count": 84}
+
+    and top_values reads the first few of them, in the same form the
+    aggregations returned ({"_id": value, "count": n}):
+
+    print_query(top_values(db.southbendin, "amenities", 20))
+
+    The counts are kept while the documents are shaped, by a
+    RollupCounter (a sink, see osm_convert), and added to the rollup
+    collection with a $merge aggregation stage, so loading more data adds
+    to the counts instead of recounting everything. load_map and
+    apply_changes do this with rollups=True; for a json file loaded with
+    mongoimport, pass a counter to process_map and merge it afterwards:
+
+    counter = RollupCounter()
+    process_map(file_in, sinks=[JsonLinesSink(file_in + ".json"), counter], **mappings)
+    merge_rollups(db.southbendin, counter)
+
+    Data changed by other means (the mongo shell) is not counted;
+    rebuild_rollups recounts a whole collection with one aggregation per
+    rollup.
+"""
+
+from collections import Counter
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+
+# rollup: (field, whether documents without the field are left out);
+# the report groups users over every document, so a missing user counts
+ROLLUPS = {"users": ("created.user", False),
+           "zip_codes": ("tiger.zip_left", True),
+           "bicycle": ("bicycle", True),
+           "amenities": ("amenity", True)}
+ROLLUP_INDEX = IndexModel([("rollup", ASCENDING), ("count", DESCENDING)],
+                          name="rollup_count")
+MISSING = object()
+
+
+def rollup_collection(collection):
+    """ the collection the rollups of collection are kept in """
+    return collection.database[collection.name + "_rollups"]
+
+
+def field_value(doc, keys):
+    """ value of a dotted field of doc (split into keys), or MISSING """
+    for key in keys:
+        if not isinstance(doc, dict) or key not in doc:
+            return MISSING
+        doc = doc[key]
+    return doc
+
+
+class RollupCounter(object):
+    """ counts of the ROLLUPS field values of the documents written to it """
+
+    def __init__(self, rollups=ROLLUPS):
+        self.rollups = rollups
+        self.counts = dict((name, Counter()) for name in rollups)
+        self.fields = [(self.counts[name], field.split("."), exists)
+                       for name, (field, exists) in rollups.items()]
+
+    def add(self, doc, sign=1):
+        for counts, keys, exists in self.fields:
+            value = field_value(doc, keys)
+            if value is MISSING:
+                if exists:
+                    continue
+                value = None
+            counts[value] += sign
+
+    def remove(self, doc):
+        self.add(doc, -1)
+
+    def update(self, other):
+        """ add the counts of another RollupCounter """
+        for name, counts in other.counts.items():
+            self.counts[name].update(counts)
+
+    def write(self, el):
+        self.add(el)
+
+    def close(self):
+        pass
+
+    def documents(self):
+        """ the rollup documents of the counts that are not zero """
+        docs = []
+        for name, counts in self.counts.items():
+            for value, count in counts.items():
+                if count:
+                    docs.append({"_id": {"rollup": name, "value": value},
+                                 "rollup": name, "value": value, "count": count})
+        return docs
+
+
+def merge_rollups(collection, counter):
+    """ add the counts of counter to the rollups of collection """
+    docs = counter.documents()
+    if not docs:
+        return 0
+    rollups = rollup_collection(collection)
+    rollups.create_indexes([ROLLUP_INDEX])
+    delta = collection.database[rollups.name + "_delta"]
+    delta.drop()
+    try:
+        delta.insert_many(docs, ordered=False)
+        delta.aggregate([{"$merge": {
+            "into": rollups.name, "on": "_id",
+            "whenMatched": [{"$set": {"count": {"$add": ["$count", "$$new.count"]}}}],
+            "whenNotMatched": "insert"}}])
+    finally:
+        delta.drop()
+    # values whose documents were all deleted
+    rollups.delete_many({"count": {"$lte": 0}})
+    for counts in counter.counts.values():
+        counts.clear()
+    return len(docs)
+
+
+def rebuild_rollups(collection, rollups=ROLLUPS):
+    """ recount the rollups of collection from all of its documents """
+    target = rollup_collection(collection)
+    target.drop()
+    target.create_indexes([ROLLUP_INDEX])
+    for name, (field, exists) in rollups.items():
+        pipeline = [{"$match": {field: {"$exists": 1}}}] if exists else []
+        pipeline += [
+            {"$group": {"_id": "$" + field, "count": {"$sum": 1}}},
+            {"$project": {"_id": {"rollup": name, "value": "$_id"},
+                          "rollup": {"$literal": name},
+                          "value": "$_id", "count": 1}},
+            {"$merge": {"into": target.name, "on": "_id", "whenMatched": "replace",
+                        "whenNotMatched": "insert"}}]
+        collection.aggregate(pipeline, allowDiskUse=True)
+
+
+def top_query(rollup, limit=10):
+    """ the find of top_values, as the arguments of a find command """
+    return {"filter": {"rollup": rollup}, "projection": {"_id": 0, "value": 1, "count": 1},
+            "sort": [("count", DESCENDING), ("value", ASCENDING)], "limit": limit}
+
+
+def top_values(collection, rollup, limit=10):
+    """ the limit most common values of a rollup as [{"_id": value,
+        "count": n}], like the $group / $sort / $limit aggregation
+    """
+    query = top_query(rollup, limit)
+    docs = rollup_collection(collection).find(query["filter"], query["projection"])
+    docs = docs.sort(query["sort"]).limit(query["limit"])
+    return [{"_id": doc["value"], "count": doc["count"]} for doc in docs]
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+"""
+    Run the report's MongoDB queries concurrently and time each one.
+
+    The report ran a dozen independent queries one after another, so it
+    took as long as all of them together, most of it spent waiting on
+    the server. run_report sends them all at once from a pool of
+    max_workers threads (pymongo releases the GIL while it waits on the
+    network, and a MongoClient is safe to share between threads), so the
+    report takes about as long as its slowest query (as long as there
+    are no more queries than threads):
+
+    report, timings = run_report(db.southbendin)
+    report["counts"]["nodes"], report["top users"]
+    print_timings(timings)
+
+    The queries are REPORT_QUERIES, a list of (name, function of the
+    collection) pairs: the summary counts (one aggregation, cached by
+    collection version, see osm_report), the Notre Dame finds (see
+    osm_search), and the rankings read from the rollups (see
+    osm_rollups). timings has the seconds each query took on its thread,
+    plus "total" for the whole report.
+
+    The query functions also list the server commands they send, so
+    explain_report explains exactly what the report runs (see
+    osm_indexes for the columns):
+
+    print_explain_report(explain_report(db.southbendin))
+
+    Each thread holds at most one connection, so the client's connection
+    pool (maxPoolSize, 100 by default) needs to be at least max_workers
+    for all of them to run at once.
+"""
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from bson.son import SON
+
+from osm_indexes import explain_query
+from osm_report import summary_counts, SUMMARY_FACETS
+from osm_search import search_filter, search_names
+from osm_rollups import rollup_collection, top_query, top_values
+
+
+MAX_WORKERS = 16
+
+
+class Counts(object):
+    """ query function: summary_counts """
+
+    def __call__(self, collection):
+        return summary_counts(collection)
+
+    def commands(self, collection):
+        """ (collection, command, arguments) sent on a cache miss """
+        return [(collection, "count", {}),
+                (collection, "aggregate", {"pipeline": [{"$facet": SUMMARY_FACETS}],
+                                           "cursor": {}})]
+
+
+class Find(object):
+    """ query function: documents matching query """
+
+    def __init__(self, query, projection):
+        self.query = query
+        self.projection = projection
+
+    def __call__(self, collection):
+        return list(collection.find(self.query, self.projection))
+
+    def commands(self, collection):
+        return [(collection, "find", {"filter": self.query, "projection": self.projection})]
+
+
+class SearchNames(object):
+    """ query function: documents with text in one of fields (see osm_search) """
+
+    def __init__(self, text, fields, projection):
+        self.text = text
+        self.fields = fields
+        self.projection = projection
+
+    def __call__(self, collection):
+        return list(search_names(collection, self.text, self.fields, self.projection))
+
+    def commands(self, collection):
+        query = search_filter(collection, self.text, self.fields)
+        return [(collection, "find", {"filter": query, "projection": self.projection})]
+
+
+class Top(object):
+    """ query function: most common values of a rollup """
+
+    def __init__(self, rollup, limit):
+        self.rollup = rollup
+        self.limit = limit
+
+    def __call__(self, collection):
+        return top_values(collection, self.rollup, self.limit)
+
+    def commands(self, collection):
+        query = top_query(self.rollup, self.limit)
+        query["sort"] = SON(query["sort"])
+        return [(rollup_collection(collection), "find", query)]
+
+
+REPORT_QUERIES = [
+    # documents, nodes, ways, users, schools, and hospitals
+    ("counts", Counts()),
+    ("notre dame stadium", Find({"name": "Notre Dame Stadium"},
+                                {"_id": 0, "name": 1, "operator": 1, "owner": 1,
+                                 "sport": 1, "start_date": 1})),
+    ("notre dame", SearchNames("Notre", ("name",), {"_id": 0, "name": 1})),
+    ("top users", Top("users", 10)),
+    ("top zip codes", Top("zip_codes", 10)),
+    ("bicycle lanes", Top("bicycle", 10)),
+    ("top amenities", Top("amenities", 20)),
+]
+
+
+def timed_query(query, collection):
+    """ (result, seconds) of one query function """
+    start = time.time()
+    result = query(collection)
+    return result, time.time() - start
+
+
+def run_report(collection, queries=REPORT_QUERIES, max_workers=MAX_WORKERS):
+    """ results and timings of queries, run on max_workers threads """
+    start = time.time()
+    pool = ThreadPool(max(1, min(max_workers, len(queries))))
+    try:
+        pending = [pool.apply_async(timed_query, (query, collection))
+                   for _, query in queries]
+        done = [result.get() for result in pending]
+    finally:
+        pool.close()
+        pool.join()
+    results = {}
+    timings = {}
+    for (name, _), (result, seconds) in zip(queries, done):
+        results[name] = result
+        timings[name] = seconds
+    timings["total"] = time.time() - start
+    return results, timings
+
+
+def explain_report(collection, queries=REPORT_QUERIES):
+    """ explain_query for each command the queries send, as a list of
+        rows; query functions without commands are left out
+    """
+    rows = []
+    for name, query in queries:
+        commands = getattr(query, "commands", lambda c: [])(collection)
+        for target, command, arguments in commands:
+            row = explain_query(target, command, arguments)
+            row["query"] = name if len(commands) == 1 else "{0} ({1})".format(name, command)
+            rows.append(row)
+    return rows
+
+
+def print_timings(timings):
+    """ one line per query, slowest first, then the total """
+    total = timings.get("total")
+    for name, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        if name != "total":
+            print("{0:<24} {1:8.1f} ms".format(name, seconds * 1000))
+    if total is not None:
+        print("{0:<24} {1:8.1f} ms".format("total", total * 1000))
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+"""
+    Substring and fuzzy search of names and streets with a trigram index.
+
+    The report found the Notre Dame locations with
+    {"name": {"$regex": ".*Notre.*"}}; an unanchored regular expression
+    cannot use an index, so every document is read. search_names does the
+    same search with an inverted index of the trigrams (runs of three
+    characters) of every distinct name and street:
+
+    print_query(search_names(db.southbendin, "Notre", fields=("name",),
+                             projection={"_id": 0, "name": 1}))
+    search_names(db.southbendin, "Notre Dme Stadum", fuzzy=True)
+
+    A substring query is cut into trigrams, the posting lists of those
+    trigrams are intersected to find the few values that can contain it,
+    and those values are checked and then fetched by the ordinary
+    indexes on the fields ({"name": {"$in": [...]}}). A fuzzy query ranks
+    the values by the share of trigrams they have in common with it
+    (their Jaccard similarity), so misspellings still match. Queries
+    shorter than three characters have no trigrams and fall back to a
+    $regex scan.
+
+    Names repeat heavily, so only the distinct values are indexed. The
+    index is kept as NumPy arrays (trigram keys, offsets into a posting
+    array of value numbers, and the values themselves as utf-8 bytes),
+    saved to a .npz file in cache_dir and held in memory, both keyed by
+    the collection's version token (see osm_mongo), so it is built once
+    per load. Collections the tools never loaded or changed have no
+    token, and their index is only kept in memory.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from osm_mongo import collection_token
+from osm_report import cached
+
+
+SEARCH_FIELDS = ("name", "address.street")
+
+
+def trigrams(text):
+    """ set of the trigrams of text (lowercased), each packed in an int """
+    text = text.lower()
+    return set((ord(text[i]) << 42) | (ord(text[i + 1]) << 21) | ord(text[i + 2])
+               for i in range(len(text) - 2))
+
+
+class TrigramIndex(object):
+    """ trigram posting lists over a list of distinct values; fields[i]
+        has bit j set if values[i] is found in the j-th search field
+    """
+
+    def __init__(self, values, fields, keys, offsets, postings):
+        self.values = values
+        self.fields = fields
+        self.keys = keys
+        self.offsets = offsets
+        self.postings = postings
+        self.sizes = np.array([len(trigrams(v)) for v in values], dtype=np.int32)
+
+    @classmethod
+    def build(cls, values, fields):
+        """ index of values (a list of strings) and their field bits """
+        keys = []
+        ids = []
+        for i, value in enumerate(values):
+            grams = trigrams(value)
+            keys.extend(grams)
+            ids.extend([i] * len(grams))
+        keys = np.array(keys, dtype=np.int64)
+        ids = np.array(ids, dtype=np.int32)
+        order = np.lexsort((ids, keys))
+        keys = keys[order]
+        unique, starts = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+        return cls(list(values), np.asarray(fields, dtype=np.uint8), unique, offsets, ids[order])
+
+    def save(self, filename):
+        encoded = [v.encode("utf-8") for v in self.values]
+        ends = np.cumsum([len(v) for v in encoded], dtype=np.int64)
+        np.savez(filename, values=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                 value_ends=ends, fields=self.fields, keys=self.keys,
+                 offsets=self.offsets, postings=self.postings)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        blob = data["values"].tobytes()
+        starts = np.concatenate(([0], data["value_ends"][:-1]))
+        values = [blob[s:e].decode("utf-8") for s, e in zip(starts, data["value_ends"])]
+        return cls(values, data["fields"], data["keys"], data["offsets"], data["postings"])
+
+    def posting(self, key):
+        """ value numbers whose values have the trigram key """
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return self.postings[:0]
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def substring(self, text, field_mask=0xff, ignore_case=False):
+        """ values containing text, found in one of the masked fields """
+        grams = trigrams(text)
+        postings = sorted((self.posting(key) for key in grams), key=len)
+        found = postings[0] if postings else self.postings[:0]
+        for posting in postings[1:]:
+            found = np.intersect1d(found, posting, assume_unique=True)
+        found = found[(self.fields[found] & field_mask) != 0]
+        # the trigrams only narrow the candidates down: check each one
+        if ignore_case:
+            text = text.lower()
+            return [self.values[i] for i in found if text in self.values[i].lower()]
+        return [self.values[i] for i in found if text in self.values[i]]
+
+    def fuzzy(self, text, field_mask=0xff, limit=10, threshold=0.3):
+        """ up to limit (value, similarity) pairs, most similar first """
+        grams = trigrams(text)
+        postings = [self.posting(key) for key in grams]
+        if not postings:
+            return []
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.values))
+        candidates = np.nonzero(shared)[0]
+        candidates = candidates[(self.fields[candidates] & field_mask) != 0]
+        similarity = shared[candidates] / (
+            len(grams) + self.sizes[candidates] - shared[candidates]).astype(np.float64)
+        keep = similarity >= threshold
+        candidates, similarity = candidates[keep], similarity[keep]
+        best = np.argsort(-similarity, kind="mergesort")[:limit]
+        return [(self.values[candidates[i]], float(similarity[i])) for i in best]
+
+
+def distinct_values(collection, field):
+    """ distinct string values of field """
+    values = collection.aggregate([{"$match": {field: {"$exists": 1}}},
+                                   {"$group": {"_id": "$" + field}}], allowDiskUse=True)
+    return [v["_id"] for v in values if isinstance(v["_id"], type(u""))]
+
+
+def build_name_index(collection, fields=SEARCH_FIELDS):
+    """ TrigramIndex of the distinct values of fields """
+    bits = {}
+    for j, field in enumerate(fields):
+        for value in distinct_values(collection, field):
+            bits[value] = bits.get(value, 0) | (1 << j)
+    values = sorted(bits)
+    return TrigramIndex.build(values, [bits[v] for v in values])
+
+
+def name_index(collection, fields=SEARCH_FIELDS, cache_dir="name_index", refresh=False):
+    """ build_name_index, read from or saved to cache_dir and kept in
+        memory until the collection version changes
+    """
+    def load(collection):
+        token = collection_token(collection)
+        if token is None:
+            return build_name_index(collection, fields)
+        key = json.dumps([collection.database.name, collection.name, token, list(fields)])
+        path = os.path.join(cache_dir, "{0}.{1}.npz".format(
+            collection.name, hashlib.md5(key.encode("utf-8")).hexdigest()))
+        if os.path.exists(path) and not refresh:
+            return TrigramIndex.load(path)
+        index = build_name_index(collection, fields)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        index.save(path)
+        return index
+    return cached(collection, ("name_index", tuple(fields), cache_dir), load, refresh)
+
+
+def search_filter(collection, text, fields=SEARCH_FIELDS, fuzzy=False, ignore_case=False,
+                  limit=10, index_fields=SEARCH_FIELDS, cache_dir="name_index"):
+    """ the query of search_names: the values found in the trigram index
+        of index_fields, or a $regex if text is shorter than three
+        characters
+    """
+    if not fuzzy and len(text) < 3:
+        regex = {"$regex": re.escape(text)}
+        if ignore_case:
+            regex["$options"] = "i"
+        return {"$or": [{f: regex} for f in fields]}
+    index = name_index(collection, index_fields, cache_dir)
+    mask = sum(1 << index_fields.index(f) for f in fields)
+    if fuzzy:
+        values = [v for v, _ in index.fuzzy(text, mask, limit)]
+    else:
+        values = index.substring(text, mask, ignore_case)
+    return {"$or": [{f: {"$in": values}} for f in fields]}
+
+
+def search_names(collection, text, fields=SEARCH_FIELDS, projection=None, fuzzy=False,
+                 ignore_case=False, limit=10, index_fields=SEARCH_FIELDS,
+                 cache_dir="name_index"):
+    """ cursor of the documents with text in one of fields (or, with
+        fuzzy, a value similar to it), using the trigram index of
+        index_fields unless text is shorter than three characters
+    """
+    query = search_filter(collection, text, fields, fuzzy, ignore_case, limit,
+                          index_fields, cache_dir)
+    return collection.find(query, projection)
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+"""
+    Spatial helpers for the pos (latitude, longitude) field of the
+    southbendin collection.
+
+    export_positions pulls every pos into two float64 NumPy arrays
+    without building a Python dictionary per document. Only pos is
+    projected (no _id), the cursor uses large batches, and the batches
+    are read as raw BSON: a document holding nothing but a pair of
+    doubles always has the same 37 byte layout, so a whole batch is
+    decoded at once with np.frombuffer. Batches with any other layout
+    (for example integer coordinates) are decoded document by document.
+
+    lat, lon = export_positions(db.southbendin)
+
+    The same is done for other fixed layouts: iter_layout_batches reads
+    the documents of a cursor as NumPy structured arrays of a given dtype
+    (ID_POS_DTYPE for {_id, pos}, ID_BBOX_DTYPE for {_id, bbox}), checked
+    field by field against a template document (see osm_affiliation).
+
+    With filename the positions are written to a memory-mapped .npy file
+    of shape (n, 2) instead of being held in memory, and can be reopened
+    later with np.load(filename, mmap_mode="r").
+
+    For plotting, density_grid bins the positions into a bins x bins 2D
+    histogram instead of drawing one transparent marker per node. The
+    counts are accumulated batch by batch as the cursor is read, or with
+    server=True computed by MongoDB itself with a $group on the grid cell
+    of each position, so only the non-empty cells are sent back.
+    density_tile caches each grid on disk, keyed by the collection's
+    version token (see osm_mongo), the resolution, and the extent, so
+    drawing the same map again does not read the collection at all
+    (collections the tools never loaded or changed have no token and are
+    not cached):
+
+    grid, extent = density_tile(db.southbendin, bins=512, cache_dir="tiles")
+    plot_density(grid, extent)
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import bson
+from bson.son import SON
+
+from osm_mongo import collection_token
+
+
+POS_QUERY = {"pos": {"$exists": 1}}
+POS_PROJECTION = {"_id": 0, "pos": 1}
+
+# the BSON encoding of {"pos": [lat, lon]} with both values doubles
+POS_DTYPE = np.dtype([("size", "<i4"), ("array_type", "u1"), ("array_key", "S4"),
+                      ("array_size", "<i4"), ("lat_type", "u1"), ("lat_key", "S2"),
+                      ("lat", "<f8"), ("lon_type", "u1"), ("lon_key", "S2"),
+                      ("lon", "<f8"), ("end", "S2")])
+
+
+def _pair_fields(prefix):
+    """ dtype fields of the body of a BSON array of two doubles """
+    return [(prefix + "size", "<i4"), (prefix + "0_type", "u1"), (prefix + "0_key", "S2"),
+            (prefix + "0", "<f8"), (prefix + "1_type", "u1"), (prefix + "1_key", "S2"),
+            (prefix + "1", "<f8"), (prefix + "end", "u1")]
+
+
+# the BSON encoding of {"_id": ObjectId, "pos": [lat, lon]}
+ID_FIELDS = [("size", "<i4"), ("id_type", "u1"), ("id_key", "S4"), ("id", "V12")]
+ID_POS_DTYPE = np.dtype(ID_FIELDS + [("pos_type", "u1"), ("pos_key", "S4")] +
+                        _pair_fields("pos") + [("end", "u1")])
+# and of {"_id": ObjectId, "bbox": [[lat min, lon min], [lat max, lon max]]}
+ID_BBOX_DTYPE = np.dtype(ID_FIELDS + [("bbox_type", "u1"), ("bbox_key", "S5"),
+                                      ("bbox_size", "<i4"), ("min_type", "u1"),
+                                      ("min_key", "S2")] + _pair_fields("min") +
+                         [("max_type", "u1"), ("max_key", "S2")] + _pair_fields("max") +
+                         [("bbox_end", "u1"), ("end", "u1")])
+# the documents those layouts are checked against, and their value fields
+LAYOUTS = {
+    ID_POS_DTYPE: (SON([("_id", bson.ObjectId()), ("pos", [0.0, 0.0])]),
+                   ("id", "pos0", "pos1")),
+    ID_BBOX_DTYPE: (SON([("_id", bson.ObjectId()), ("bbox", [[0.0, 0.0], [0.0, 0.0]])]),
+                    ("id", "min0", "min1", "max0", "max1")),
+}
+
+
+def decode_layout(batch, dtype):
+    """ structured array of the documents of a raw BSON batch, or None
+        unless every one has the layout of dtype
+    """
+    template, values = LAYOUTS[dtype]
+    template = np.frombuffer(bson.BSON.encode(template), dtype=dtype)
+    if len(batch) % dtype.itemsize:
+        return None
+    docs = np.frombuffer(batch, dtype=dtype)
+    for name in dtype.names:
+        if name not in values and (docs[name] != template[name]).any():
+            return None
+    return docs
+
+
+def iter_layout_batches(collection, query, projection, dtype, batch_size=100000):
+    """ the documents matching query, one cursor batch at a time, as
+        structured arrays of dtype, or as lists of documents for batches
+        of any other layout and collections without raw batches
+    """
+    try:
+        batches = collection.find_raw_batches(query, projection, batch_size=batch_size)
+    except (AttributeError, NotImplementedError):
+        yield list(collection.find(query, projection))
+        return
+    for batch in batches:
+        if batch:
+            docs = decode_layout(batch, dtype)
+            yield docs if docs is not None else bson.decode_all(batch)
+
+
+def decode_positions(batch):
+    """ (n, 2) array of the positions in a raw BSON batch of documents """
+    if len(batch) % POS_DTYPE.itemsize == 0:
+        docs = np.frombuffer(batch, dtype=POS_DTYPE)
+        if ((docs["size"] == POS_DTYPE.itemsize).all() and
+                (docs["lat_type"] == 1).all() and (docs["lon_type"] == 1).all() and
+                (docs["array_key"] == b"pos").all()):
+            return np.column_stack((docs["lat"], docs["lon"]))
+    return np.array([doc["pos"] for doc in bson.decode_all(batch)], dtype=np.float64)
+
+
+def iter_position_batches(collection, query=POS_QUERY, batch_size=100000):
+    """ (n, 2) float64 arrays of positions, one per cursor batch """
+    try:
+        batches = collection.find_raw_batches(query, POS_PROJECTION,
+                                              batch_size=batch_size)
+    except (AttributeError, NotImplementedError):
+        # collections without raw batches (e.g. mongomock)
+        pos = [doc["pos"] for doc in collection.find(query, POS_PROJECTION)]
+        yield np.array(pos, dtype=np.float64).reshape(-1, 2)
+        return
+    for batch in batches:
+        if batch:
+            yield decode_positions(batch)
+
+
+def export_positions(collection, filename=None, query=POS_QUERY, batch_size=100000):
+    """ lat and lon arrays of every document matching query """
+    n = collection.count_documents(query)
+    if filename:
+        positions = np.lib.format.open_memmap(filename, mode="w+",
+                                              dtype=np.float64, shape=(n, 2))
+    else:
+        positions = np.empty((n, 2), dtype=np.float64)
+    i = 0
+    for batch in iter_position_batches(collection, query, batch_size):
+        # documents added since the count are left out
+        batch = batch[:n - i]
+        positions[i:i + len(batch)] = batch
+        i += len(batch)
+    positions = positions[:i]
+    if filename:
+        positions.flush()
+    return positions[:, 0], positions[:, 1]
+
+
+def position_extent(collection, query=POS_QUERY):
+    """ ((lat min, lat max), (lon min, lon max)) of the positions """
+    lat = {"$arrayElemAt": ["$pos", 0]}
+    lon = {"$arrayElemAt": ["$pos", 1]}
+    bounds = list(collection.aggregate([
+        {"$match": query},
+        {"$group": {"_id": None, "lat_min": {"$min": lat}, "lat_max": {"$max": lat},
+                    "lon_min": {"$min": lon}, "lon_max": {"$max": lon}}}]))
+    if not bounds:
+        return (0.0, 0.0), (0.0, 0.0)
+    b = bounds[0]
+    return (b["lat_min"], b["lat_max"]), (b["lon_min"], b["lon_max"])
+
+
+def density_grid(collection, bins=512, extent=None, query=POS_QUERY,
+                 server=False, batch_size=100000):
+    """ (bins x bins array of position counts, extent) with rows by lat
+        and columns by lon; the extent is found with position_extent
+        unless given
+    """
+    if extent is None:
+        extent = position_extent(collection, query)
+    (lat_min, lat_max), (lon_min, lon_max) = extent
+    grid = np.zeros((bins, bins), dtype=np.int64)
+    if server:
+        # cell index of each position, the maximum falling in the last cell
+        def cell(index, low, high):
+            width = float(high - low) / bins or 1.0
+            value = {"$arrayElemAt": ["$pos", index]}
+            return {"$min": [bins - 1, {"$floor": {"$divide": [
+                {"$subtract": [value, low]}, width]}}]}
+        inside = {"pos.0": {"$gte": lat_min, "$lte": lat_max},
+                  "pos.1": {"$gte": lon_min, "$lte": lon_max}}
+        for c in collection.aggregate([
+                {"$match": {"$and": [query, inside]}},
+                {"$group": {"_id": {"lat": cell(0, lat_min, lat_max),
+                                    "lon": cell(1, lon_min, lon_max)},
+                            "count": {"$sum": 1}}}], allowDiskUse=True):
+            grid[int(c["_id"]["lat"]), int(c["_id"]["lon"])] += c["count"]
+    else:
+        for batch in iter_position_batches(collection, query, batch_size):
+            counts, _, _ = np.histogram2d(batch[:, 0], batch[:, 1], bins=bins,
+                                          range=extent)
+            grid += counts.astype(np.int64)
+    return grid, extent
+
+
+def density_tile(collection, bins=512, extent=None, query=POS_QUERY,
+                 cache_dir="tiles", server=False):
+    """ density_grid, read from or saved to a .npz tile in cache_dir """
+    token = collection_token(collection)
+    if token is None:
+        return density_grid(collection, bins, extent, query, server)
+    key = json.dumps([collection.database.name, collection.name, token, bins, extent, query],
+                     sort_keys=True)
+    name = "{0}.{1}.npz".format(collection.name, hashlib.md5(key.encode("utf-8")).hexdigest())
+    path = os.path.join(cache_dir, name)
+    if os.path.exists(path):
+        tile = np.load(path)
+        return tile["grid"], tuple(tuple(float(v) for v in row) for row in tile["extent"])
+    grid, extent = density_grid(collection, bins, extent, query, server)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    np.savez_compressed(path, grid=grid, extent=np.array(extent))
+    return grid, extent
+
+
+def plot_density(grid, extent, ax=None, cmap="Blues", **kwargs):
+    """ draw a density grid as an image, log scaled, lat on the x axis
+        and lon on the y axis like the scatter plot it replaces
+    """
+    import matplotlib.pyplot as plt
+    ax = ax or plt.gca()
+    (lat_min, lat_max), (lon_min, lon_max) = extent
+    return ax.imshow(np.log1p(grid.T), origin="lower", aspect="auto", cmap=cmap,
+                     extent=[lat_min, lat_max, lon_min, lon_max],
+                     interpolation="nearest", **kwargs)
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+"""
+    Constant-memory streaming over an Open Street Map XML file.
+
+    ET.iterparse builds the whole document tree as it goes, so a loop
+    over iterparse that never clears anything holds the entire file in
+    memory by the time it finishes. The readers here free every
+    top-level element (node, way, relation, bounds, ...) as soon as the
+    caller is done with it, so memory use depends on the size of the
+    largest element rather than on the size of the file.
+
+    iterparse_clear(filename) yields every element, children first,
+    exactly like ET.iterparse(filename) does with its default "end"
+    events; use it where every tag matters (for example counting tags).
+
+    iter_elements(filename) yields only the top-level node, way, and
+    relation elements, each one complete with its tag/nd/member children.
+
+    iter_changes(filename) reads an OSM change file (.osc), where the
+    elements are grouped in <create>, <modify>, and <delete> blocks, and
+    yields (action, element) pairs in file order.
+
+    Every reader takes a file name or an open binary file. Files ending in
+    .bz2, .gz, or .xz are decompressed on the fly as they are read (see
+    open_osm), so an extract never has to be decompressed to disk:
+
+    for element in iter_elements("south-bend_indiana.osm.bz2"):
+        ...
+
+    A bz2 file written by a parallel compressor (pbzip2, lbzip2) is a
+    series of independent bz2 streams. Such files are cut at the stream
+    headers and the streams are decompressed by a pool of processes,
+    a few at a time and handed back in file order. With one process they
+    are decompressed one after the other, never by bz2.BZ2File, which
+    stops at the end of the first stream on Python 2.
+"""
+
+import bz2
+import gzip
+import mmap
+import multiprocessing
+import os
+import re
+import xml.etree.cElementTree as ET
+from collections import deque
+
+
+ELEMENT_TAGS = ("node", "way", "relation")
+COMPRESSED_EXTENSIONS = (".bz2", ".gz", ".xz")
+# a bz2 stream header ("BZh" and the block size) followed by the magic
+# number that starts its first block
+BZ2_STREAM_RE = re.compile(b"BZh[1-9]1AY&SY")
+
+
+class ChunkReader(object):
+    """ a read-only binary file over an iterator of byte strings """
+
+    def __init__(self, chunks, close=None):
+        self.chunks = chunks
+        self.buf = b""
+        self.on_close = close
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+        if size < 0:
+            data, self.buf = self.buf, b""
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def close(self):
+        if self.on_close is not None:
+            self.on_close()
+            self.on_close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def bz2_streams(filename):
+    """ (start, end) byte offsets of each bz2 stream in filename """
+    with open(filename, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            starts = [m.start() for m in BZ2_STREAM_RE.finditer(data)]
+            size = len(data)
+        finally:
+            data.close()
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def _decompress_stream(filename, start, end):
+    """ the decompressed bytes of one bz2 stream """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        return bz2.decompress(f.read(end - start))
+
+
+def open_bz2_streams(filename, streams=None):
+    """ a file reading a multi-stream bz2 file one stream at a time;
+        streams are its bz2_streams, if already found
+    """
+    if streams is None:
+        streams = bz2_streams(filename)
+    return ChunkReader(_decompress_stream(filename, start, end) for start, end in streams)
+
+
+def open_bz2_parallel(filename, processes=None, streams=None):
+    """ a file reading a multi-stream bz2 file, decompressed in parallel
+        (or with processes=1 one stream at a time); streams are its
+        bz2_streams, if already found
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if streams is None:
+        streams = bz2_streams(filename)
+    if processes == 1:
+        return open_bz2_streams(filename, streams)
+    pool = multiprocessing.Pool(processes)
+
+    def chunks():
+        pending = deque()
+        for start, end in streams:
+            pending.append(pool.apply_async(_decompress_stream, (filename, start, end)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close():
+        pool.terminate()
+        pool.join()
+    return ChunkReader(chunks(), close)
+
+
+def open_osm(filename, processes=None):
+    """ binary file of the xml in filename, decompressed if it ends in
+        .bz2, .gz, or .xz; multi-stream bz2 files are decompressed by
+        processes worker processes (all cores by default, 1 to decompress
+        them one after the other)
+    """
+    if filename.endswith(".bz2"):
+        streams = bz2_streams(filename)
+        if len(streams) > 1 and streams[0][0] == 0:
+            return open_bz2_parallel(filename, processes, streams)
+        return bz2.BZ2File(filename, "rb")
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    if filename.endswith(".xz"):
+        try:
+            import lzma
+        except ImportError:
+            raise ValueError("{0}: reading .xz files needs the lzma module "
+                             "(Python 3.3 or later)".format(filename))
+        return lzma.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def iterparse(source, events=("start", "end")):
+    """ ET.iterparse of a file name (see open_osm) or binary file """
+    if hasattr(source, "read"):
+        for item in ET.iterparse(source, events=events):
+            yield item
+        return
+    with open_osm(source) as f:
+        for item in ET.iterparse(f, events=events):
+            yield item
+
+
+def iterparse_clear(source):
+    """ ET.iterparse "end" events, freeing each top-level element after
+        it (and all of its children) has been yielded
+    """
+    root = None
+    depth = 0
+    for event, elem in iterparse(source):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        yield elem
+        if depth == 1:
+            # a direct child of <osm> is finished: drop it from the tree
+            elem.clear()
+            root.remove(elem)
+
+
+def iter_elements(source, tags=ELEMENT_TAGS):
+    """ yield the complete top-level elements whose tag is in tags """
+    root = None
+    depth = 0
+    for event, elem in iterparse(source):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if elem.tag in tags:
+                yield elem
+            elem.clear()
+            root.remove(elem)
+
+
+def iter_changes(source, tags=ELEMENT_TAGS):
+    """ yield (action, element) for every element of an osmChange file
+        whose tag is in tags; action is "create", "modify", or "delete"
+    """
+    blocks = []
+    depth = 0
+    for event, elem in iterparse(source):
+        if event == "start":
+            depth += 1
+            if depth == 2:
+                blocks.append(elem)
+            continue
+        depth -= 1
+        if depth == 2:
+            if elem.tag in tags:
+                yield blocks[-1].tag, elem
+            elem.clear()
+            blocks[-1].remove(elem)
+        elif depth == 1:
+            blocks.pop()
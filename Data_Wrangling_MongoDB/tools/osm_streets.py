@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+"""
+    Street type normalizer for street names ("addr:street" and "name").
+
+    The report used to fix a street name by searching it for its last
+    word with a regular expression and then calling
+    name.replace(abbreviation, full), which scans the whole name and also
+    replaces the abbreviation where it appears earlier in the name
+    ("St Joseph St" became "Street Joseph Street"), and raises KeyError
+    for street types missing from the mapping.
+
+    A StreetNormalizer splits each name once at its last space and looks
+    the last word up in the mapping, so only the street type itself is
+    ever replaced and names with an unknown street type come back as
+    they are:
+
+    normalize = StreetNormalizer(mapping_street_name)
+    normalize("St Joseph St")           # "St Joseph Street"
+    normalize("Notre Dame Stadium")     # unchanged
+    updates_street_names = normalize.fixes(names)
+
+    Street names repeat heavily, so the result for each distinct name is
+    memoized in a least recently used cache of cache_size names, and
+    stats() reports the calls and the cache hit rate (osm_benchmark times
+    the normalizer; it does not time itself).
+
+    The normalizer also audits the names it is given, so the fixes do not
+    have to be worked out by a separate pass before the conversion:
+    report() has the number of names by street type and the names that
+    were fixed. Both are kept for at most report_size distinct street
+    types and names; once either is full, names of new street types are
+    left out of the counts, new fixes are not recorded, and the report is
+    marked truncated. merge_reports combines the reports of several
+    normalizers.
+"""
+
+from collections import Counter, OrderedDict
+
+
+class StreetNormalizer(object):
+    """ replaces the street type (last word) of names found in mapping,
+        memoizing the result for the cache_size most recently used names
+        and auditing up to report_size street types and fixed names
+    """
+
+    def __init__(self, mapping, cache_size=100000, report_size=10000):
+        self.mapping = dict(mapping)
+        self.cache_size = cache_size
+        self.report_size = report_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fixed = {}
+        self.street_types = {}
+        self.truncated = False
+
+    def normalize(self, name):
+        """ name with its street type replaced, uncached """
+        head, sep, last = name.rpartition(" ")
+        full = self.mapping.get(last)
+        if full is None:
+            return name
+        return head + sep + full
+
+    def __call__(self, name):
+        cache = self.cache
+        try:
+            # move to the most recently used end
+            value, last = cache.pop(name)
+            self.hits += 1
+        except KeyError:
+            last = name.rpartition(" ")[2]
+            value = self.normalize(name)
+            self.misses += 1
+            if value != name and name not in self.fixed:
+                if len(self.fixed) < self.report_size:
+                    self.fixed[name] = value
+                else:
+                    self.truncated = True
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[name] = (value, last)
+        street_types = self.street_types
+        if last in street_types:
+            street_types[last] += 1
+        elif len(street_types) < self.report_size:
+            street_types[last] = 1
+        else:
+            self.truncated = True
+        return value
+
+    def fixes(self, names):
+        """ {name: normalized name} for the names that change """
+        fixed = {}
+        for name in names:
+            better_name = self(name)
+            if better_name != name:
+                fixed[name] = better_name
+        return fixed
+
+    def stats(self):
+        """ calls, cache hits and misses, and hit rate """
+        calls = self.hits + self.misses
+        return {"calls": calls, "hits": self.hits, "misses": self.misses,
+                "hit_rate": float(self.hits) / calls if calls else 0.0,
+                "cached": len(self.cache)}
+
+    def report(self):
+        """ what was seen while normalizing: the number of names by street
+            type (last word), the names that were fixed, whether either
+            was cut at report_size, and the stats
+        """
+        return {"street_types": dict(self.street_types), "fixed": dict(self.fixed),
+                "truncated": self.truncated, "stats": self.stats()}
+
+
+def merge_reports(reports):
+    """ one report of several StreetNormalizer reports: street types
+        counted together, the fixes of all of them, and the stats summed
+    """
+    street_types = Counter()
+    fixed = {}
+    truncated = False
+    totals = Counter()
+    for report in reports:
+        street_types.update(report["street_types"])
+        fixed.update(report["fixed"])
+        truncated = truncated or report["truncated"]
+        totals.update(dict((k, report["stats"][k]) for k in ("calls", "hits", "misses", "cached")))
+    stats = dict((k, totals[k]) for k in ("calls", "hits", "misses", "cached"))
+    stats["hit_rate"] = float(stats["hits"]) / stats["calls"] if stats["calls"] else 0.0
+    return {"street_types": dict(street_types), "fixed": fixed, "truncated": truncated,
+            "stats": stats}
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+
+"""
+    Checks that the faster tools give the same results as the code they
+    replace, in the style of the case study's test() functions.
+
+    usage: python osm_tests.py [osm file]
+
+    Without a file the checks run on a small synthetic map written by
+    write_example, cleaned with the South Bend rules (rules/south_bend.json):
+
+    test()                  # every check, on the synthetic map
+    test("example.osm")     # every check, on a copy of example.osm
+    test_search(filename, load_rules(SOUTH_BEND_RULES))
+
+    The files a check writes go to a temporary directory that is removed
+    afterwards. osm_benchmark times the same tools.
+
+    The checks of load_map and apply_changes (resuming from a checkpoint,
+    rollup counts, change geometry) run on an in-memory mongomock
+    database, so they need no server. mongomock has no $merge stage and
+    its bulk_write does not take pymongo 4 operations; mongomock_database
+    fills in both, for these checks only.
+"""
+
+import hashlib
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+
+import pandas as pd
+
+from osm_convert import process_map, process_map_parallel, iter_shaped
+from osm_clean import Cleaner, load_rules
+from osm_columnar import columnar_cache, clean_values
+from osm_mongo import apply_changes, load_map, write_checkpoint
+from osm_rollups import RollupCounter, merge_rollups, rollup_collection
+from osm_search import TrigramIndex
+
+
+SOUTH_BEND_RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "rules", "south_bend.json")
+
+EXAMPLE_STREETS = [u"Main St", u"Lincoln Ave", u"Ironwood Dr", u"Angela Blvd.", u"Eddy Street",
+                   u"Notre Dame Avenue", u"Stadium Crt", u"St Joseph Ct", u"Portage Trl"]
+EXAMPLE_NAMES = [u"Notre Dame Stadium", u"Dillon Hall", u"University of Notre Dame",
+                 u"Memorial Hospital", u"Caf\u00e9 Navarre"]
+EXAMPLE_TAGS = [("addr:street", EXAMPLE_STREETS),
+                ("name", EXAMPLE_NAMES + EXAMPLE_STREETS),
+                ("tiger:name_type", [u"St", u"Ave", u"Ave:Blvd", u"Cir; Way", u"Way"]),
+                ("tiger:zip_left", [u"46556", u"46617:46628", u"46601;46613"]),
+                ("tiger:county", [u"St. Joseph, IN", u"St. Joseph, IN:Elkhart, IN"]),
+                ("surface", [u"asphalt", u"dirt", u"fine_gravel", u"paved,_gravel"])]
+
+
+def write_example(filename, elements=500, seed=0):
+    """ a synthetic map of elements nodes and ways (and a few relations)
+        carrying the tags the report cleans
+    """
+    rnd = random.Random(seed)
+
+    def attrs(i):
+        return u'id="{0}" version="{1}" changeset="{2}" timestamp="2015-01-01T00:00:00Z" ' \
+               u'user="user{3}" uid="{3}"'.format(i, rnd.randint(1, 9),
+                                                 rnd.randint(1, 10 ** 6), rnd.randint(1, 5))
+
+    def tags():
+        return u"".join(u'    <tag k="{0}" v="{1}"/>\n'.format(k, rnd.choice(v))
+                        for k, v in EXAMPLE_TAGS if rnd.random() < 0.2)
+
+    nodes = max(2, elements * 4 // 5)
+    lines = [u'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n',
+             u' <bounds minlat="41.6" minlon="-86.4" maxlat="41.8" maxlon="-86.1"/>\n']
+    for i in range(1, nodes + 1):
+        lines.append(u'  <node {0} lat="{1:.7f}" lon="{2:.7f}">\n{3}  </node>\n'.format(
+            attrs(i), 41.6 + rnd.random() * 0.2, -86.4 + rnd.random() * 0.3, tags()))
+    for i in range(nodes + 1, elements + 1):
+        nds = u"".join(u'    <nd ref="{0}"/>\n'.format(rnd.randint(1, nodes))
+                       for _ in range(rnd.randint(2, 6)))
+        lines.append(u'  <way {0}>\n{1}{2}  </way>\n'.format(attrs(i), nds, tags()))
+        if i % 20 == 0:
+            lines.append(u'  <relation {0}>\n    <member type="way" ref="{1}" role="outer"/>\n'
+                         u'    <tag k="type" v="multipolygon"/>\n  </relation>\n'.format(
+                             attrs(elements + i), i))
+    lines.append(u"</osm>\n")
+    with open(filename, "wb") as f:
+        f.write(u"".join(lines).encode("utf-8"))
+
+
+def random_values(mappings, n, seed=0):
+    """ n random values for a tag: mapped values, values with and without
+        delimiters, unicode, and empty strings
+    """
+    rnd = random.Random(seed)
+    alphabet = u"ab Z09;:,.-\u00e9\u4e2d\n"
+    mapped = [k for name, mapping in mappings.items() if name != "rules" for k in mapping]
+    values = []
+    for _ in range(n):
+        if rnd.random() < 0.3:
+            values.append(rnd.choice(mapped))
+        else:
+            values.append(u"".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 12))))
+    return values
+
+
+def file_digest(filename):
+    with open(filename, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def test_clean_values(filename, mappings, samples=2000):
+    """ clean_values gives the Cleaner's value for every value of every
+        rule key, random and from the file
+    """
+    key_rules = Cleaner(**mappings).key_rules
+    tags = columnar_cache(filename)["tags"]
+    for i, key in enumerate(sorted(mappings["rules"])):
+        found = tags["v"][(tags["k"] == key).values].astype(object).tolist()
+        values = random_values(mappings, samples, seed=i) + found
+        cleaned = clean_values(pd.Series(values), key, **mappings).tolist()
+        expected = [key_rules[key](v) for v in values]
+        bad = [(v, c, e) for v, c, e in zip(values, cleaned, expected) if c != e]
+        assert not bad, "{0}: {1}".format(key, bad[:5])
+
+
+def test_parallel(filename, mappings, shard_bytes=4096):
+    """ process_map_parallel writes the same bytes as process_map, with
+        shards small enough that the file is cut many times
+    """
+    process_map(filename, **mappings)
+    expected = file_digest(filename + ".json")
+    for processes in (1, 2):
+        process_map_parallel(filename, False, processes, shard_bytes, **mappings)
+        assert file_digest(filename + ".json") == expected, processes
+
+
+def test_search(filename, mappings):
+    """ the trigram index finds the same names as the report's regex """
+    names = [el["name"] for el in iter_shaped(filename, **mappings)
+             if isinstance(el.get("name"), type(u""))]
+    values = sorted(set(names))
+    index = TrigramIndex.build(values, [1] * len(values))
+    queries = set([u"Notre", u"Dame Ave", u"Hall", u"Street", u"Caf\u00e9", u"zzz"])
+    queries.update(name[1:5] for name in values)
+    for text in sorted(queries):
+        regex = re.compile(".*" + re.escape(text) + ".*")
+        expected = set(name for name in names if regex.match(name))
+        assert set(index.substring(text)) == expected, text
+
+
+def merge_value(expression, old, new):
+    """ value of a $merge whenMatched $add expression ("$field" of the
+        existing document, "$$new.field" of the merged one)
+    """
+    if isinstance(expression, dict):
+        return sum(merge_value(e, old, new) for e in expression["$add"])
+    if expression.startswith("$$new."):
+        return new[expression[len("$$new."):]]
+    return old[expression[1:]]
+
+
+def mongomock_database(name="osm_tests"):
+    """ an empty mongomock database, with $merge (replace, or a $set
+        pipeline of $add expressions) and pymongo 4 bulk_write filled in
+    """
+    import mongomock
+    from mongomock.collection import Collection
+
+    if not getattr(Collection, "osm_tests", False):
+        aggregate = Collection.aggregate
+
+        def merge_aggregate(self, pipeline, **kwargs):
+            if not pipeline or "$merge" not in pipeline[-1]:
+                return aggregate(self, pipeline, **kwargs)
+            merge = pipeline[-1]["$merge"]
+            target = self.database[merge["into"]]
+            for doc in aggregate(self, pipeline[:-1], **kwargs):
+                old = target.find_one({"_id": doc["_id"]})
+                if old is None:
+                    target.insert_one(doc)
+                elif merge["whenMatched"] == "replace":
+                    target.replace_one({"_id": doc["_id"]}, doc)
+                else:
+                    update = {}
+                    for stage in merge["whenMatched"]:
+                        for field, expression in stage["$set"].items():
+                            update[field] = merge_value(expression, old, doc)
+                    target.update_one({"_id": doc["_id"]}, {"$set": update})
+            return iter([])
+
+        def bulk_write(self, operations, ordered=True):
+            for operation in operations:
+                if type(operation).__name__ == "ReplaceOne":
+                    self.replace_one(operation._filter, operation._doc, upsert=operation._upsert)
+                elif type(operation).__name__ == "DeleteOne":
+                    self.delete_one(operation._filter)
+                elif type(operation).__name__ == "UpdateMany":
+                    self.update_many(operation._filter, operation._doc, upsert=operation._upsert)
+                else:
+                    raise NotImplementedError(type(operation).__name__)
+
+        Collection.aggregate = merge_aggregate
+        Collection.bulk_write = bulk_write
+        Collection.osm_tests = True
+    return mongomock.MongoClient()[name]
+
+
+def write_changes(filename, **actions):
+    """ an osmChange file of actions: {"create": [xml], "modify": [...],
+        "delete": [...]}, the elements as xml strings
+    """
+    lines = [u'<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n']
+    for action in ("create", "modify", "delete"):
+        if actions.get(action):
+            lines.append(u"<{0}>\n{1}\n</{0}>\n".format(action, u"\n".join(actions[action])))
+    lines.append(u"</osmChange>\n")
+    with open(filename, "wb") as f:
+        f.write(u"".join(lines).encode("utf-8"))
+
+
+def change_element(tag, id, user=u"changer", lat=None, lon=None, refs=(), members=(), tags=()):
+    """ xml of one element of a change file """
+    attrs = u'id="{0}" version="2" changeset="9" timestamp="2016-01-01T00:00:00Z" ' \
+            u'user="{1}" uid="99"'.format(id, user)
+    if lat is not None:
+        attrs += u' lat="{0}" lon="{1}"'.format(lat, lon)
+    body = u"".join(u'<nd ref="{0}"/>'.format(ref) for ref in refs)
+    body += u"".join(u'<member type="{0}" ref="{1}" role="{2}"/>'.format(*m) for m in members)
+    body += u"".join(u'<tag k="{0}" v="{1}"/>'.format(k, v) for k, v in tags)
+    return u"<{0} {1}>{2}</{0}>".format(tag, attrs, body)
+
+
+def rollup_counts(collection):
+    """ {(rollup, value): count} of the rollups of collection """
+    return dict(((doc["rollup"], doc["value"]), doc["count"])
+                for doc in rollup_collection(collection).find())
+
+
+def recounted(collection):
+    """ rollup_counts as they should be, counted from every document """
+    counter = RollupCounter()
+    for doc in collection.find():
+        counter.add(doc)
+    return dict(((doc["rollup"], doc["value"]), doc["count"]) for doc in counter.documents())
+
+
+def test_resume(filename, mappings):
+    """ a load_map that died part way through a batch, before writing its
+        checkpoint, resumes without duplicates or lost documents
+    """
+    collection = mongomock_database().southbendin
+    load_map(filename, collection, batch_size=50, **mappings)
+    docs = collection.count_documents({})
+    assert docs > 120, docs
+    # the third batch was only partly inserted, and its checkpoint lost
+    collection.delete_many({"_id": {"$in": [doc["_id"] for doc in collection.find().skip(120)]}})
+    checkpoint = filename + ".checkpoint"
+    write_checkpoint(checkpoint, filename, 100, 100)
+    stats = load_map(filename, collection, batch_size=50, checkpoint=checkpoint, **mappings)
+    assert stats["documents"] == docs - 120, stats
+    assert stats["skipped"] == 100, stats
+    keys = [(doc["type"], doc["id"]) for doc in collection.find()]
+    assert len(keys) == docs and len(set(keys)) == docs, (len(keys), len(set(keys)), docs)
+    assert not os.path.exists(checkpoint)
+
+
+def test_merge_rollups(filename, mappings):
+    """ merge_rollups adds to the counts through the delta collection,
+        drops values counted down to zero, and leaves no delta behind
+    """
+    collection = mongomock_database().southbendin
+    counter = RollupCounter()
+    counter.add({"amenity": u"school", "created": {"user": u"a"}})
+    counter.add({"amenity": u"cafe", "created": {"user": u"a"}})
+    merge_rollups(collection, counter)
+    assert rollup_counts(collection) == {("amenities", u"school"): 1, ("amenities", u"cafe"): 1,
+                                         ("users", u"a"): 2}
+    counter.add({"amenity": u"school", "created": {"user": u"b"}})
+    counter.remove({"amenity": u"cafe", "created": {"user": u"a"}})
+    merge_rollups(collection, counter)
+    assert rollup_counts(collection) == {("amenities", u"school"): 2, ("users", u"a"): 1,
+                                         ("users", u"b"): 1}
+    delta = rollup_collection(collection).name + "_delta"
+    assert delta not in collection.database.list_collection_names()
+
+
+def test_changes(filename, mappings):
+    """ apply_changes creates, modifies, and deletes documents (deletes
+        by element type, whatever the type tag says), and keeps the
+        rollups equal to a recount
+    """
+    collection = mongomock_database().southbendin
+    load_map(filename, collection, rollups=True, relations=True, **mappings)
+    assert rollup_counts(collection) == recounted(collection)
+    node = collection.find_one({"type": "node"})
+    way = collection.find_one({"type": "way"})
+    # found by its members, whatever its type field says
+    relation = collection.find_one({"members": {"$exists": 1}})
+    changes = filename + ".osc"
+    route = u"8000001"
+    write_changes(changes, create=[
+        change_element(u"node", u"8000002", lat=41.7, lon=-86.2, tags=[(u"amenity", u"school")]),
+        change_element(u"way", route, refs=[node["id"]], tags=[(u"type", u"route"),
+                                                               (u"amenity", u"bus_station")])
+    ], modify=[
+        change_element(u"node", node["id"], user=u"modifier", lat=41.71, lon=-86.21,
+                       tags=[(u"amenity", u"cafe")]),
+        change_element(u"way", way["id"], refs=[node["id"]], tags=[(u"bicycle", u"yes")])
+    ], delete=[
+        change_element(u"relation", relation["id"])
+    ])
+    stats = apply_changes(changes, collection, rollups=True, relations=True, **mappings)
+    assert (stats["created"], stats["modified"], stats["deleted"]) == (2, 2, 1), stats
+    assert collection.count_documents({"type": "way", "id": route, "way_type": u"route"}) == 1
+    assert collection.find_one({"type": "node", "id": node["id"]})["amenity"] == u"cafe"
+    assert collection.count_documents({"members": {"$exists": 1}, "id": relation["id"]}) == 0
+    assert rollup_counts(collection) == recounted(collection)
+
+    write_changes(changes, delete=[change_element(u"way", route),
+                                   change_element(u"node", u"8000002")])
+    stats = apply_changes(changes, collection, batch_size=1, rollups=True, **mappings)
+    assert stats["deleted"] == 2, stats
+    assert collection.count_documents({"id": {"$in": [route, u"8000002"]}}) == 0, \
+        list(collection.find({"id": {"$in": [route, u"8000002"]}}))
+    assert rollup_counts(collection) == recounted(collection)
+
+
+def test_change_geometry(filename, mappings):
+    """ ways and relations changed by apply_changes get their geometry
+        from the node index of the load and the nodes of the change file
+    """
+    collection = mongomock_database().southbendin
+    geometry = ("coords", "bbox", "members")
+    load_map(filename, collection, geometry=geometry, relations=True, **mappings)
+    way = collection.find_one({"type": "way", "coords.1": {"$exists": 1}})
+    refs = way["node_refs"][:2]
+    positions = [collection.find_one({"type": "node", "id": ref})["pos"] for ref in refs]
+    changes = filename + ".osc"
+    write_changes(changes, create=[
+        change_element(u"node", u"8000003", lat=50.0, lon=-80.0)
+    ], modify=[
+        change_element(u"way", way["id"], refs=refs + [u"8000003"]),
+        change_element(u"relation", u"8000004", members=[(u"way", way["id"], u"outer"),
+                                                         (u"node", u"8000003", u"")])
+    ])
+    apply_changes(changes, collection, geometry=geometry, nodes=filename + ".nodes",
+                  relations=True, **mappings)
+    changed = collection.find_one({"type": "way", "id": way["id"]})
+    assert changed["coords"] == positions + [[50.0, -80.0]], changed["coords"]
+    lat = [p[0] for p in changed["coords"]]
+    lon = [p[1] for p in changed["coords"]]
+    assert changed["bbox"] == [[min(lat), min(lon)], [max(lat), max(lon)]], changed["bbox"]
+    relation = collection.find_one({"type": "relation", "id": u"8000004"})
+    assert relation["bbox"] == changed["bbox"], relation["bbox"]
+    assert [m["bbox"] for m in relation["members"]] == [changed["bbox"], [[50.0, -80.0]] * 2]
+
+
+def test(filename=None):
+    directory = tempfile.mkdtemp()
+    try:
+        example = os.path.join(directory, "example.osm")
+        if filename is None:
+            write_example(example)
+        else:
+            shutil.copy(filename, example)
+        mappings = load_rules(SOUTH_BEND_RULES)
+        for check in (test_clean_values, test_parallel, test_search, test_resume,
+                      test_merge_rollups, test_changes, test_change_geometry):
+            check(example, mappings)
+            print("{0:<32} ok".format(check.__name__))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test(*sys.argv[1:2])